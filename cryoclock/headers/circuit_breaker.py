@@ -0,0 +1,102 @@
+"""
+Failure handling for instrument connections.
+
+A `CircuitBreaker` counts consecutive failures of one device. Once there
+are `threshold` of them the circuit opens: calls fail straight away with
+`DeviceUnavailable`, so an instrument that has gone away doesn't hold up
+every caller for a full timeout. Meanwhile a background thread tries to
+recover the device with exponential backoff, and closes the circuit again
+once it answers.
+"""
+from typing import Callable, Optional
+import threading
+
+from colorama import Fore, Style
+
+
+class DeviceUnavailable(ConnectionError):
+    """Raised instead of talking to a device whose circuit is open."""
+
+
+class CircuitBreaker:
+
+    def __init__(self,
+            name: str,
+            recover: Callable[[], None],
+            threshold: int = 3,
+            backoff: float = 1.0, # seconds
+            max_backoff: float = 60.0, # seconds
+        ):
+        """
+        name: str
+            Used in messages.
+
+        recover: callable
+            Reconnects to the device and checks that it answers, raising
+            an exception if it doesn't. Called from the probe thread.
+
+        threshold: int
+            Consecutive failures after which the circuit opens.
+
+        backoff, max_backoff: float
+            First and longest wait between recovery attempts.
+        """
+        self.name = name
+        self._recover = recover
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open = False
+        self._stopped = threading.Event()
+        self._probe: Optional[threading.Thread] = None
+
+
+    @property
+    def is_open(self) -> bool: return self._open
+
+
+    def check(self) -> None:
+        """Raise `DeviceUnavailable` if the circuit is open."""
+        if self._open:
+            raise DeviceUnavailable(f'{self.name} is unavailable; reconnecting in the background.')
+
+
+    def success(self) -> None:
+        self._failures = 0
+
+
+    def failure(self, error: BaseException) -> None:
+        """Record a failed call, opening the circuit after too many in a row."""
+        with self._lock:
+            self._failures += 1
+            if self._open or self._failures < self.threshold or self._stopped.is_set(): return
+
+            self._open = True
+            print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {self.name} failed {self._failures} times in a row ({error!r}). Failing fast until it recovers.')
+            self._probe = threading.Thread(target=self._probe_loop, name=f'probe {self.name}', daemon=True)
+            self._probe.start()
+
+
+    def stop(self) -> None:
+        """Stop probing, e.g. because the device is being closed."""
+        self._stopped.set()
+
+
+    def _probe_loop(self) -> None:
+        delay = self.backoff
+        while not self._stopped.wait(delay):
+            try:
+                self._recover()
+            except Exception as error:
+                delay = min(2 * delay, self.max_backoff)
+                print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {Style.DIM}Couldn\'t reconnect to {self.name} ({error!r}), retrying in {delay:g} s.{Style.RESET_ALL}')
+                continue
+
+            with self._lock:
+                self._failures = 0
+                self._open = False
+            print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Reconnected to {Style.RESET_ALL}{Style.BRIGHT}{self.name}{Style.RESET_ALL}')
+            return
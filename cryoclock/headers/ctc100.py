@@ -1,6 +1,5 @@
 from typing import List
 import re
-import telnetlib
 import time
 import os
 
@@ -8,6 +7,46 @@ from headers.usbtmc import USBTMCDevice
 #from headers.usbtmc import USBTMCDevice
 
 
+class CTC100ResponseError(ValueError):
+    """The CTC100 answered, but not with something we could parse."""
+
+
+# Any decimal number, including integers and exponents. Compiled once.
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+def parse_value(response, verbose="Low"):
+    """
+    Extract the number from a CTC100 reply.
+
+    With verbose Low the reply is just the number, so float() takes it
+    directly. Higher verbosities pad it as "<name> = <value>"; slicing
+    after the last "=" keeps digits in the name (e.g. "40K plat") from
+    being mistaken for the value. The regex is only a fallback, e.g. for
+    trailing units, and only takes a number at the start of the value.
+    Raises CTC100ResponseError for error replies ("Error: ...") and if
+    there is no number.
+    """
+    if response.lstrip().lower().startswith("error"):
+        raise CTC100ResponseError(f"CTC100 returned an error: {response!r}")
+
+    if verbose.lower() == "low":
+        try:
+            return float(response)
+        except ValueError:
+            pass # Padded after all; fall through.
+
+    text = response[response.rfind("=") + 1:]
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    match = _NUMBER.match(text.strip())
+    if match is None:
+        raise CTC100ResponseError(f"No value in CTC100 response {response!r}")
+    return float(match.group())
+
+
 
 class CTC100(USBTMCDevice):
     """
@@ -35,13 +74,39 @@ class CTC100(USBTMCDevice):
     Date: June 23, 2023
     """
 
-    def __init__(self, ip_address,multiplexed=False):
-        """Connect to the the CTC100."""
-        if multiplexed:
+    # Metadata that rarely changes. Our own writes invalidate these
+    # entries; the TTLs bound how stale front-panel changes can get.
+    cache_ttl = {
+        '*IDN?': float('inf'),
+        'getOutput.names': 60,
+        'outputEnable?': 10,
+    }
+
+    _control = None
+
+    def __init__(self, ip_address,multiplexed=False, tcp_port=23, mode=None, verbose="Low"):
+        """
+        Connect to the the CTC100.
+
+        verbose: the system.com.verbose setting. "Low" replies carry just
+        the value, which is fewer bytes and the fastest to parse; the
+        parser copes with "Medium" and "High" too. With "High" every
+        setting is acknowledged, so sets wait for their reply.
+
+        tcp_port: the telnet port; only differs from 23 for the simulator
+        (see headers/ctc100_simulator.py).
+
+        mode: overrides the connection mode, e.g. 'serial' to use a USB
+        serial port or the simulator's pty, in which case 'ip_address' is its path.
+        """
+        if mode is not None:
+            super().__init__(ip_address, tcp_port=tcp_port, mode=mode)
+        elif multiplexed:
             super().__init__(ip_address, mode='multiplexed') # multiplexed connection. here 'ip_address' is actually a local port number.
         else:
-            super().__init__(ip_address, tcp_port=23, mode='ethernet') # direct connection
-        self._set_variable('system.com.verbose', 'Medium')
+            super().__init__(ip_address, tcp_port=tcp_port, mode='ethernet') # direct connection
+        self._verbose = "Medium" # Until we've set it
+        self._set_variable('system.com.verbose', verbose)
         self._set_variable('system.display.Figures', 4)
 
         
@@ -65,8 +130,13 @@ class CTC100(USBTMCDevice):
         
         var = var.replace(" ", "") # Remove spaces from the variable name. They're optional and can potentially cause problems
         val = "({})".format(val) # Wrap argument in parentheses, just in case. This prevents an argument containing a space from causing unexpected issues
+        self._invalidate_variable(var)
+        if var.lower() == "system.com.verbose": self._verbose = val.strip("()")
 
-        # Replace with query if verbose mode is high
+        # High verbosity acknowledges every setting; read the acknowledgement
+        # here, or it would be taken as the answer to the next query.
+        if self._verbose.lower() == "high":
+            return self.query(f"{var} = {val}")
         return self.send_command(f"{var} = {val}")
 
         
@@ -79,8 +149,16 @@ class CTC100(USBTMCDevice):
         
         var = var.replace(" ", "") # Remove spaces from the variable name. They're optional and can potentially cause problems
         val = "({})".format(val) # Wrap argument in parentheses, just in case. This prevents an argument containing a space from causing unexpected issues
+        self._invalidate_variable(var)
         return self.query("{} += {}".format(var, val))
 
+
+    def _invalidate_variable(self, var):
+        """Drop cached responses that a write to `var` may change."""
+        self.invalidate(f"{var}?")
+        if var.lower().endswith(".name"): # Renaming a channel changes the list of names
+            self.invalidate("getOutput.names")
+
     def setAlarm(self, channel, Tmin, Tmax):
         """Enables alarm with 4 beeps on a channel for a given range."""
         
@@ -109,17 +187,33 @@ class CTC100(USBTMCDevice):
         name has been changed from the default or you wish to read the
         value of an output channel, the full name must be passed as a
         string. Otherwise, an integer will work.
+
+        Returns NaN if the controller doesn't answer in time, and raises
+        CTC100ResponseError if the answer has no value in it.
         """
 
         if not isinstance(channel, str): #Sets string for channel
             channel = f"In{channel}"
             
         response = self._get_variable(f"{channel}.value")
-        if response is None: return None
-   
-        # Extract the response using a regex in case verbose mode is on
-        match = re.search(r"[-+]?\d*\.\d+", response)
-        return float(match.group()) if match is not None else None
+        if response is None: return float("nan")
+        return parse_value(response, self._verbose)
+
+
+    async def aread(self, channel):
+        """
+        Coroutine version of `read`. Lets one event loop poll several
+        controllers at once::
+
+            >>> await asyncio.gather(*(c.aread('In1') for c in controllers))
+        """
+
+        if not isinstance(channel, str): #Sets string for channel
+            channel = f"In{channel}"
+
+        response = await self.aquery(f"{channel.replace(' ', '')}.value?")
+        if response is None: return float("nan")
+        return parse_value(response, self._verbose)
 
 
     def ramp_temperature(self, channel, temp=0.0, rate=0.1):
@@ -156,6 +250,117 @@ class CTC100(USBTMCDevice):
     def disable_output(self): self._set_variable("outputEnable", "off")
 
 
+    @property
+    def control(self):
+        """
+        Background executor for ramps and heater sequences, so they don't
+        block acquisition. See headers/ctc100_control.py.
+        """
+        if self._control is None:
+            from headers.ctc100_control import ControlExecutor
+            self._control = ControlExecutor(self)
+        return self._control
+
+
+    def close(self) -> None:
+        if self._control is not None:
+            self._control.shutdown(wait=False)
+        super().close()
+
+
     @property
     def channels(self) -> List[str]:
-        return self.query('getOutput.names').split(',')
+        return [name.strip() for name in self.query('getOutput.names').split(',')]
+
+
+    def read_all(self, as_array=False):
+        """
+        Read every channel with a single getOutput query, so all values
+        share one timestamp and cost one round trip (the channel names are
+        cached). Returns a dict of channel name to value in `channels`
+        order, or a NumPy array in that order if `as_array` is True.
+        Values that couldn't be read are NaN.
+        """
+        names = self.channels
+        response = self.query('getOutput')
+
+        if response is None:
+            values = [float('nan')] * len(names)
+        else:
+            values = [self._parse_field(field) for field in response.split(',')]
+            if len(values) != len(names):
+                raise ValueError(f'getOutput returned {len(values)} values for {len(names)} channels.')
+
+        if as_array:
+            import numpy as np
+            return np.array(values, dtype=float)
+        return dict(zip(names, values))
+
+
+    # One point of the controller's data log, answered as "<time>, <value>".
+    # <which> is first, last, next or prev; each channel keeps its own cursor.
+    log_command = 'getLog.xy "{channel}", {which}'
+
+    @property
+    def log_interval(self):
+        """Seconds between points in the controller's data log."""
+        return parse_value(self._get_variable("system.log.interval"), self._verbose)
+
+
+    def read_log(self, channels=None, count=100, chunk=None):
+        """
+        Read the newest `count` points of the controller's internal data log
+        for each of `channels` (default: all). The queries are pipelined, so
+        the whole transfer costs about one round trip.
+
+        chunk: pipeline at most this many queries at a time (default: all
+            at once). Other threads' requests take their turn in between,
+            so a long read doesn't hold up acquisition on the same controller.
+
+        Log time stamps come from the controller's own clock, so they are
+        anchored to the host clock by taking the newest point as logged now.
+        Returns (times, {channel: values}) as NumPy arrays, oldest first.
+        Points that couldn't be read are NaN.
+        """
+        import numpy as np
+
+        channels = self.channels if channels is None else list(channels)
+        # Point by point, every channel's newest first, so a chunked read
+        # asks for all the newest points before the log can move on.
+        commands = [self.log_command.format(channel=channel, which="last") for channel in channels]
+        for i in range(count - 1):
+            commands += [self.log_command.format(channel=channel, which="prev") for channel in channels]
+
+        anchor = time.time()
+        step = chunk or len(commands) or 1
+        responses = []
+        for start in range(0, len(commands), step):
+            responses += self.query_many(commands[start:start + step])
+
+        # Responses are newest first, one row of channels per point.
+        stamps = np.full((count, len(channels)), np.nan)
+        values = np.full((count, len(channels)), np.nan)
+        for index, response in enumerate(responses):
+            if response is None: continue
+            stamp, _, value = response[response.rfind("=") + 1:].partition(",")
+            try:
+                stamps.flat[index] = float(stamp)
+                values.flat[index] = parse_value(value, "Low")
+            except (ValueError, CTC100ResponseError):
+                pass
+        stamps, values = stamps.T, values.T
+
+        # The controller logs every channel at once; take the times from
+        # whichever channel answered for each point.
+        relative = np.fmax.reduce(stamps, axis=0) if len(channels) else np.full(count, np.nan)
+        newest = relative[np.isfinite(relative)].max() if np.isfinite(relative).any() else np.nan
+        times = anchor - (newest - relative)
+        return times[::-1], {channel: values[i, ::-1] for i, channel in enumerate(channels)}
+
+
+    def _parse_field(self, text):
+        """One getOutput value; a bad channel shouldn't cost the others."""
+        try:
+            return parse_value(text, self._verbose)
+        except CTC100ResponseError:
+            return float('nan')
@@ -0,0 +1,152 @@
+"""
+Background execution of CTC100 control sequences.
+
+Ramps and heater changes are queued on a `ControlExecutor` and run on its
+own thread, one sequence at a time in submission order. Each command
+takes its turn in the device's request queue, so acquisition on the
+same controller keeps its cadence while a cooldown or warmup runs.
+
+How to use::
+
+    >>> ramp = c.control.ramp('Out1', 4.0, rate=0.05, tolerance=0.05)
+    >>> ramp.add_done_callback(lambda f: print('At base temperature'))
+    >>> ...                      # keep monitoring meanwhile
+    >>> ramp.result()            # or block until it's there
+"""
+from typing import Callable, Optional
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+import math, threading, time
+
+from colorama import Fore, Style
+
+
+class ControlExecutor:
+
+    def __init__(self,
+            ctc,
+            min_poll: float = 0.5, # seconds
+            max_poll: float = 30.0, # seconds
+        ):
+        """
+        ctc: CTC100
+            The controller to drive.
+
+        min_poll, max_poll: float
+            Bounds on how often a ramp checks its input temperature. In
+            between, the interval follows the time left to the setpoint.
+        """
+        self.ctc = ctc
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='CTC100 control')
+        self._cancelled = threading.Event()
+
+
+    def submit(self, sequence: Callable, *args, callback: Optional[Callable[[Future], None]] = None, **kwargs) -> Future:
+        """
+        Queue `sequence(*args, **kwargs)`. Returns a Future for its result;
+        `callback(future)` is called when it finishes. If `cancel` is
+        called before it starts, it never runs and the Future raises
+        CancelledError.
+        """
+        future = self._pool.submit(self._run, sequence, *args, **kwargs)
+        if callback is not None: future.add_done_callback(callback)
+        return future
+
+
+    def cancel(self) -> None:
+        """
+        Drop every queued sequence, and stop the running one at its next
+        check. Ramps check between polls; a single command that is
+        already on its way to the controller still completes.
+        """
+        self._cancelled.set()
+        self._pool.submit(self._cancelled.clear) # Re-arm once the queue has drained
+
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._cancelled.set()
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+    def _check(self) -> None:
+        if self._cancelled.is_set(): raise CancelledError()
+
+
+    def _run(self, sequence: Callable, *args, **kwargs):
+        self._check() # Queued before a cancel
+        return sequence(*args, **kwargs)
+
+
+    ##### Sequences #####
+    def ramp(self,
+            output: str,
+            temp: float,
+            rate: float = 0.1, # K/s
+            tolerance: float = 0.1, # K
+            input_channel: Optional[str] = None,
+            timeout: Optional[float] = None, # seconds
+            progress: Optional[Callable[[float, float], None]] = None,
+            callback: Optional[Callable[[Future], None]] = None,
+        ) -> Future:
+        """
+        Start a PID ramp of `output` to `temp` at `rate`, and wait in the
+        background until its input channel is within `tolerance` of `temp`.
+
+        input_channel: the channel the PID loop reads. Asked from the
+            controller (<output>.PID.input) if not given.
+
+        progress: called as progress(temperature, error) at every check.
+
+        The Future resolves to the final temperature, or raises
+        TimeoutError after `timeout` seconds.
+        """
+        return self.submit(self._ramp, output, temp, rate, tolerance, input_channel, timeout, progress, callback=callback)
+
+
+    def _ramp(self, output, temp, rate, tolerance, input_channel, timeout, progress) -> float:
+        if input_channel is None:
+            reply = self.ctc._get_variable(f"{output}.PID.input")
+            input_channel = reply[reply.rfind("=") + 1:].strip()
+
+        self.ctc.ramp_temperature(output, temp, rate)
+        print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Ramping {output} ({input_channel}) to {Style.RESET_ALL}{Style.BRIGHT}{temp} K{Style.RESET_ALL}{Style.DIM} at {rate} K/s{Style.RESET_ALL}')
+
+        start = time.monotonic()
+        while True:
+            self._check()
+            temperature = self.ctc.read(input_channel)
+            error = temperature - temp
+            if progress is not None: progress(temperature, error)
+            if abs(error) <= tolerance: return temperature
+
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'{input_channel} is at {temperature} K after {timeout} s, not {temp} K.')
+
+            # Look again when about a quarter of the remaining ramp has gone by.
+            remaining = abs(error) / abs(rate) if rate and not math.isnan(error) else self.max_poll
+            self._cancelled.wait(min(self.max_poll, max(self.min_poll, remaining / 4)))
+
+
+    def disable_PID(self, output: str, callback: Optional[Callable[[Future], None]] = None) -> Future:
+        return self.submit(self.ctc.disable_PID, output, callback=callback)
+
+
+    def set_heater(self,
+            output: str,
+            power: Optional[float] = None, # W
+            low_limit: Optional[float] = None, # W
+            high_limit: Optional[float] = None, # W
+            callback: Optional[Callable[[Future], None]] = None,
+        ) -> Future:
+        """Apply any of the heater limits and output power, limits first."""
+        def sequence():
+            if low_limit is not None: self.ctc.set_heater_low_lim(output, low_limit)
+            if high_limit is not None: self.ctc.set_heater_high_lim(output, high_limit)
+            self._check()
+            if power is not None: self.ctc.set_heater_output_power(output, power)
+        return self.submit(sequence, callback=callback)
+
+
+    def heater_off(self, output: str, callback: Optional[Callable[[Future], None]] = None) -> Future:
+        return self.submit(self.ctc.set_heater_off, output, callback=callback)
@@ -0,0 +1,431 @@
+"""
+A simulated CTC100 for testing and benchmarking without hardware.
+
+The simulator answers the subset of the CTC100 command set that the
+`CTC100` driver uses: `*IDN?`, `getOutput`, `getOutput.names`, reading and
+setting variables (`<channel>.value?`, `<channel>.PID.*`, `<channel>.alarm.*`,
+`system.com.verbose`, ...), `+=` and the data log (`getLog.xy`). Temperatures drift slowly with a
+little noise, and heater outputs with PID on ramp their input channel
+towards the setpoint at `PID.Ramp` K/s.
+
+It listens on TCP like the controller's telnet port, and can also expose
+a pty that behaves like the serial port. Latency and faults (dropped,
+garbled, delayed replies and dropped connections) can be injected.
+
+How to use::
+
+    $ python -m headers.ctc100_simulator --port 2323 --latency 0.005 --drop 0.01
+
+    >>> c = CTC100('127.0.0.1', tcp_port=2323)
+
+or, to time the driver against it::
+
+    $ python -m headers.ctc100_simulator --bench 1000
+"""
+from typing import Dict, Optional
+import argparse, collections, math, os, random, re, socket, socketserver, threading, time, tty
+
+from colorama import Fore, Style
+
+
+DEFAULT_INPUTS = ['40K plat', '4K cyl', '40K shield', 'ivc']
+DEFAULT_TEMPERATURES = [298.30, 299.83, 299.25, 299.63] # K
+DEFAULT_OUTPUTS = ['Out1', 'Out2']
+
+# Enumerated settings, as the controller spells them whatever case they were sent in.
+_ENUMS = {value.lower(): value for value in ('On', 'Off', 'Low', 'Medium', 'High', 'Level')}
+
+_SET = re.compile(r'^(?P<var>[^=+]+?)\s*(?P<op>\+?=)\s*(?P<val>.*)$')
+_GET_LOG = re.compile(r'^getlog(?P<xy>\.xy)?\s*"?(?P<channel>[^",]+?)"?\s*,\s*(?P<which>\w+)$', re.IGNORECASE)
+
+
+def _normalize(name: str) -> str:
+    """The CTC100 ignores case and spaces in names."""
+    return name.replace(' ', '').lower()
+
+
+class Faults:
+    """Probabilities (per command) of injected faults."""
+
+    def __init__(self,
+            drop: float = 0.0, # No reply at all
+            garble: float = 0.0, # Reply with junk
+            stall: float = 0.0, # Reply after `stall_time`
+            disconnect: float = 0.0, # Close the connection
+            stall_time: float = 10.0, # seconds
+        ):
+        self.drop = drop
+        self.garble = garble
+        self.stall = stall
+        self.disconnect = disconnect
+        self.stall_time = stall_time
+
+
+
+class Disconnect(Exception):
+    """Raised by `SimulatedCTC100.handle` to drop the client's connection."""
+
+
+
+class SimulatedCTC100:
+    """Controller state and command interpreter, independent of the transport."""
+
+    def __init__(self,
+            inputs=DEFAULT_INPUTS,
+            temperatures=DEFAULT_TEMPERATURES,
+            outputs=DEFAULT_OUTPUTS,
+            latency: float = 0.0, # seconds
+            jitter: float = 0.0, # seconds
+            faults: Optional[Faults] = None,
+            seed: Optional[int] = None,
+            log_size: int = 10000, # points
+        ):
+        self.latency = latency
+        self.jitter = jitter
+        self.faults = faults or Faults()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.names = list(inputs) + list(outputs)
+        self._channels: Dict[str, str] = {} # normalized name or alias -> name
+        for i, name in enumerate(inputs):
+            self._channels[_normalize(name)] = self._channels[f'in{i + 1}'] = name
+        for i, name in enumerate(outputs):
+            self._channels[_normalize(name)] = self._channels[f'out{i + 1}'] = name
+
+        self.temperatures = dict(zip(inputs, temperatures))
+        self.powers = {name: 0.0 for name in outputs}
+        self.variables: Dict[str, object] = {
+            'system.com.verbose': 'Medium',
+            'system.display.figures': 4,
+            'system.log.interval': 1.0,
+            'outputenable': 'Off',
+        }
+        for i, name in enumerate(outputs):
+            self.variables.update({
+                f'{_normalize(name)}.pid.mode': 'Off',
+                f'{_normalize(name)}.pid.ramp': 0.1,
+                f'{_normalize(name)}.pid.set': 0.0,
+                f'{_normalize(name)}.pid.input': inputs[i % len(inputs)],
+                f'{_normalize(name)}.lowlmt': 0.0,
+                f'{_normalize(name)}.hilmt': 1.0,
+            })
+        for name in inputs:
+            self.variables.update({
+                f'{_normalize(name)}.alarm.mode': 'Off',
+                f'{_normalize(name)}.alarm.sound': 'None',
+                f'{_normalize(name)}.alarm.min': 0.0,
+                f'{_normalize(name)}.alarm.max': 500.0,
+            })
+
+        self._ramps: Dict[str, float] = {} # output -> current ramp setpoint
+        self._updated = self._started = time.monotonic()
+        self.commands = 0
+
+        # Data log: (seconds since start, {channel: value}), and each channel's read cursor.
+        self._log = collections.deque(maxlen=log_size)
+        self._log_next = self._started
+        self._log_cursor: Dict[str, int] = {}
+
+
+    ##### Physics #####
+    def _advance(self) -> None:
+        """Move the simulated temperatures forward to now."""
+        now = time.monotonic()
+        dt, self._updated = now - self._updated, now
+
+        for output in self.powers:
+            key = _normalize(output)
+            if str(self.variables[f'{key}.pid.mode']).lower() != 'on':
+                self._ramps.pop(output, None)
+                continue
+
+            channel = self._channel(str(self.variables[f'{key}.pid.input']))
+            target = float(self.variables[f'{key}.pid.set'])
+            rate = abs(float(self.variables[f'{key}.pid.ramp'])) or math.inf
+            setpoint = self._ramps.setdefault(output, self.temperatures[channel])
+
+            step = rate * dt
+            setpoint = min(target, setpoint + step) if target > setpoint else max(target, setpoint - step)
+            self._ramps[output] = setpoint
+
+            # The input follows the ramp with a 5 s lag.
+            self.temperatures[channel] += (setpoint - self.temperatures[channel]) * (1 - math.exp(-dt / 5.0))
+            self.powers[output] = min(float(self.variables[f'{key}.hilmt']), abs(target - self.temperatures[channel]) * 0.01)
+
+        interval = float(self.variables['system.log.interval'])
+        if now - self._log_next > interval * self._log.maxlen:
+            self._log_next = now - interval * self._log.maxlen # Older points would fall off anyway
+        while self._log_next <= now:
+            self._log.append((self._log_next - self._started, {name: self._value(name) for name in self.names}))
+            self._log_next += interval
+
+
+    def _channel(self, name: str) -> Optional[str]:
+        return self._channels.get(_normalize(name))
+
+
+    def _value(self, name: str) -> float:
+        if name in self.powers: return self.powers[name]
+        return self.temperatures[name] + self._random.gauss(0, 2e-3)
+
+
+    ##### Formatting #####
+    def _format(self, value) -> str:
+        if isinstance(value, float):
+            return f'{value:.{int(self.variables["system.display.figures"])}f}'
+        return str(value)
+
+
+    def _reply(self, name: str, value) -> str:
+        """Pad replies the way the verbosity setting asks for."""
+        if str(self.variables['system.com.verbose']).lower() == 'low':
+            return self._format(value)
+        return f'{name} = {self._format(value)}'
+
+
+    ##### Commands #####
+    def handle(self, line: str) -> Optional[str]:
+        """
+        Execute one command line and return the reply (without terminator),
+        or None if the controller wouldn't reply. Injects latency and faults.
+        """
+        faults = self.faults
+        if faults.disconnect and self._random.random() < faults.disconnect: raise Disconnect()
+
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if faults.stall and self._random.random() < faults.stall: delay += faults.stall_time
+        if delay: time.sleep(delay)
+
+        with self._lock:
+            self.commands += 1
+            self._advance()
+            reply = self._execute(line.strip())
+
+        if reply is None: return None
+        if faults.drop and self._random.random() < faults.drop: return None
+        if faults.garble and self._random.random() < faults.garble:
+            return ''.join(self._random.choice('#?!@ xyz0123') for _ in reply)
+        return reply
+
+
+    def _execute(self, command: str) -> Optional[str]:
+        if not command: return None
+
+        if command.upper() == '*IDN?':
+            return 'Stanford_Research_Systems,CTC100,s/n000000 (simulated),ver1.0'
+
+        key = _normalize(command)
+        if key == 'getoutput.names':
+            return ', '.join(self.names)
+        if key == 'getoutput':
+            return ', '.join(self._format(self._value(name)) for name in self.names)
+
+        match = _GET_LOG.match(command)
+        if match is not None:
+            return self._get_log(match['channel'], match['which'].lower(), bool(match['xy']))
+
+        match = _SET.match(command)
+        if match is not None:
+            return self._set(match['var'], match['op'], match['val'].strip().strip('()'))
+
+        if command.endswith('?'):
+            return self._get(command[:-1])
+
+        return f'Error: unknown command {command}'
+
+
+    def _get(self, var: str) -> str:
+        key = _normalize(var)
+        head, _, tail = key.partition('.')
+        channel = self._channel(head)
+
+        if channel is not None and tail == 'value':
+            return self._reply(f'{channel}.value', self._value(channel))
+        if channel is not None and tail == 'off':
+            # Turning a heater off is a "read" of its .off variable.
+            self.variables[f'{_normalize(channel)}.pid.mode'] = 'Off'
+            self.powers[channel] = 0.0
+            return self._reply(channel, 0.0)
+        if channel is not None:
+            key = f'{_normalize(channel)}.{tail}'
+
+        if key not in self.variables:
+            return f'Error: unknown variable {var}'
+        return self._reply(var, self.variables[key])
+
+
+    def _get_log(self, channel: str, which: str, xy: bool) -> str:
+        name = self._channel(channel)
+        if name is None: return f'Error: unknown channel {channel}'
+        if not self._log: return 'Error: log is empty'
+
+        cursor = {
+            'first': 0,
+            'last': len(self._log) - 1,
+            'next': self._log_cursor.get(name, -1) + 1,
+            'prev': self._log_cursor.get(name, len(self._log)) - 1,
+        }.get(which)
+        if cursor is None: return f'Error: unknown log position {which}'
+        cursor = min(max(cursor, 0), len(self._log) - 1)
+        self._log_cursor[name] = cursor
+
+        stamp, values = self._log[cursor]
+        value = self._format(values[name])
+        return f'{stamp:.1f}, {value}' if xy else value
+
+
+    def _set(self, var: str, op: str, value: str) -> Optional[str]:
+        key = _normalize(var)
+        head, _, tail = key.partition('.')
+        channel = self._channel(head)
+
+        if channel is not None and tail == 'value' and channel in self.powers:
+            self.powers[channel] = float(value)
+        elif channel is not None and tail == 'name':
+            self._rename(channel, value)
+        else:
+            if channel is not None: key = f'{_normalize(channel)}.{tail}'
+            if op == '+=':
+                value = float(self.variables.get(key, 0.0)) + float(value)
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = _ENUMS.get(value.lower(), value)
+            self.variables[key] = value
+
+        # Only High verbosity acknowledges settings, except for +=, which always answers.
+        if op == '+=' or str(self.variables['system.com.verbose']).lower() == 'high':
+            return self._reply(var, self.variables.get(key, value))
+        return None
+
+
+    def _rename(self, channel: str, name: str) -> None:
+        index = self.names.index(channel)
+        self.names[index] = name
+        for alias, target in list(self._channels.items()):
+            if target == channel: self._channels[alias] = name
+        self._channels[_normalize(name)] = name
+        for table in (self.temperatures, self.powers):
+            if channel in table: table[name] = table.pop(channel)
+        for old_key in [k for k in self.variables if k.startswith(_normalize(channel) + '.')]:
+            self.variables[_normalize(name) + old_key[len(_normalize(channel)):]] = self.variables.pop(old_key)
+
+
+
+##### Transports #####
+def _serve_lines(simulator: SimulatedCTC100, read, write) -> None:
+    """Answer newline-terminated commands until the stream closes."""
+    buffer = b''
+    while True:
+        data = read()
+        if not data: return
+        buffer += data.replace(b'\r', b'\n')
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if not line.strip(): continue
+            reply = simulator.handle(line.decode('utf-8', errors='replace'))
+            if reply is not None: write(reply.encode('utf-8') + b'\r\n')
+
+
+class _TelnetHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            _serve_lines(self.server.simulator, lambda: self.request.recv(4096), self.request.sendall)
+        except (Disconnect, ConnectionError):
+            pass
+
+
+class _TelnetServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve_tcp(simulator: SimulatedCTC100, host: str = '127.0.0.1', port: int = 0) -> socketserver.TCPServer:
+    """
+    Start answering on a TCP port (0 picks a free one) in a background
+    thread. The port is `server.server_address[1]`; stop with `server.shutdown()`.
+    """
+    server = _TelnetServer((host, port), _TelnetHandler)
+    server.simulator = simulator
+    threading.Thread(target=server.serve_forever, name='CTC100 simulator', daemon=True).start()
+    return server
+
+
+def serve_pty(simulator: SimulatedCTC100) -> str:
+    """Start answering on a new pty in a background thread, and return its path for serial mode."""
+    controller, device = os.openpty()
+    tty.setraw(device)
+
+    def run():
+        while True:
+            try:
+                _serve_lines(simulator, lambda: os.read(controller, 4096), lambda data: os.write(controller, data))
+            except Disconnect:
+                continue # A serial line can't hang up; just lose the command.
+            except OSError:
+                return
+
+    threading.Thread(target=run, name='CTC100 simulator (pty)', daemon=True).start()
+    return os.ttyname(device)
+
+
+
+##### Benchmark #####
+def benchmark(simulator: SimulatedCTC100, passes: int) -> None:
+    """Time full passes over the channels with the real driver against the simulator."""
+    from headers.ctc100 import CTC100
+
+    server = serve_tcp(simulator)
+    ctc = CTC100('127.0.0.1', tcp_port=server.server_address[1])
+    channels = ctc.channels
+
+    durations = []
+    for _ in range(passes):
+        start = time.perf_counter()
+        for channel in channels:
+            ctc.read(channel)
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    print(f'{passes} passes over {len(channels)} channels: '
+          f'median {1e3 * durations[len(durations) // 2]:.3f} ms, '
+          f'p99 {1e3 * durations[int(0.99 * (len(durations) - 1))]:.3f} ms, '
+          f'{passes / sum(durations):.0f} passes/s')
+    ctc.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2323, help='TCP port (the real controller uses 23)')
+    parser.add_argument('--pty', action='store_true', help='also serve on a pty, for serial mode')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random delay, up to this many seconds')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability of not replying')
+    parser.add_argument('--garble', type=float, default=0.0, help='probability of a garbled reply')
+    parser.add_argument('--stall', type=float, default=0.0, help='probability of a 10 s stall')
+    parser.add_argument('--disconnect', type=float, default=0.0, help='probability of dropping the connection')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--bench', type=int, metavar='PASSES', help='run the driver benchmark and exit')
+    args = parser.parse_args()
+
+    simulator = SimulatedCTC100(
+        latency=args.latency, jitter=args.jitter, seed=args.seed,
+        faults=Faults(drop=args.drop, garble=args.garble, stall=args.stall, disconnect=args.disconnect),
+    )
+
+    if args.bench:
+        benchmark(simulator, args.bench)
+    else:
+        server = serve_tcp(simulator, args.host, args.port)
+        print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Simulated CTC100 listening on {Style.RESET_ALL}{Style.BRIGHT}{args.host}:{server.server_address[1]}{Style.RESET_ALL}')
+        if args.pty:
+            print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Simulated CTC100 serial port at {Style.RESET_ALL}{Style.BRIGHT}{serve_pty(simulator)}{Style.RESET_ALL}')
+        try:
+            while True: time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,207 @@
+"""
+Local multiplexer server for sharing LAN instruments between processes.
+
+Each instrument gets one upstream TCP connection and one local port.
+Clients (`USBTMCDevice` in 'multiplexed' mode) speak a line-based
+protocol on the local port:
+
+    lock      ->  locked       wait for exclusive use of the instrument
+    <command>                  forwarded verbatim to the instrument
+    read      ->  <response>   next buffered response line, or 'read failed'
+    unlock    ->  unlocked     hand the instrument to the next client
+
+Lock requests are granted in arrival order. A `read` returns a buffered
+response immediately, and otherwise waits for the instrument to answer
+(up to `read_timeout`) instead of failing straight away.
+
+How to use::
+
+    $ python -m headers.multiplexer 5025=192.168.0.105:23
+
+    >>> c = CTC100(5025, multiplexed=True)
+"""
+from typing import Dict, List, Optional, Tuple
+import argparse, asyncio, collections
+
+from colorama import Fore, Style
+
+
+class Instrument:
+    """One upstream connection, shared by every client of a local port."""
+
+    def __init__(self,
+            host: str,
+            port: int = 23,
+            read_termination: bytes = b'\n',
+            timeout: float = 5, # seconds
+            read_timeout: float = 5, # seconds
+        ):
+        self.host = host
+        self.port = port
+        self.read_termination = read_termination
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+
+        # asyncio.Lock wakes waiters in FIFO order, so transactions are fair.
+        self.lock = asyncio.Lock()
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._pump: Optional[asyncio.Task] = None
+        self._lines: collections.deque = collections.deque()
+        self._arrived = asyncio.Event()
+
+
+    def __str__(self) -> str: return f'{self.host}:{self.port}'
+
+
+    async def connect(self) -> None:
+        """Opens the upstream connection if it is not already open."""
+        if self._writer is not None and not self._writer.is_closing(): return
+
+        print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Connecting to instrument at {Style.RESET_ALL}{Style.BRIGHT}{self}{Style.RESET_ALL}')
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        self._pump = asyncio.create_task(self._read_lines(self._reader))
+
+
+    async def close(self) -> None:
+        if self._pump is not None: self._pump.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+    async def _read_lines(self, reader: asyncio.StreamReader) -> None:
+        """Buffers every response line as soon as it arrives."""
+        try:
+            while True:
+                line = await reader.readuntil(self.read_termination)
+                self._lines.append(line)
+                self._arrived.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] Lost connection to {self}.')
+            self._writer = None
+
+
+    def discard(self) -> None:
+        """Drops responses nobody read, so they can't leak into the next transaction."""
+        self._lines.clear()
+        self._arrived.clear()
+
+
+    async def write(self, data: bytes) -> None:
+        await self.connect()
+        self._writer.write(data)
+        await self._writer.drain()
+
+
+    async def read(self) -> Optional[bytes]:
+        """Returns the next response line, waiting up to `read_timeout` for one."""
+        while not self._lines:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), self.read_timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self._lines.popleft()
+
+
+
+class Multiplexer:
+    """Serves one or more instruments, each on its own local port."""
+
+    def __init__(self, instruments: Dict[int, Instrument], host: str = '127.0.0.1'):
+        self.instruments = instruments
+        self.host = host
+        self._servers: List[asyncio.AbstractServer] = []
+
+
+    async def start(self) -> None:
+        for port, instrument in self.instruments.items():
+            await instrument.connect()
+            server = await asyncio.start_server(
+                lambda r, w, i=instrument: self._serve_client(i, r, w), self.host, port)
+            self._servers.append(server)
+            print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Serving {Style.RESET_ALL}{Style.BRIGHT}{instrument}{Style.RESET_ALL}{Style.DIM} on port {Style.RESET_ALL}{Style.BRIGHT}{port}{Style.RESET_ALL}')
+
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        await asyncio.gather(*(server.serve_forever() for server in self._servers))
+
+
+    async def close(self) -> None:
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        for instrument in self.instruments.values():
+            await instrument.close()
+
+
+    async def _serve_client(self, instrument: Instrument, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        holding = False
+        try:
+            while True:
+                # At EOF, readline returns the unterminated 'unlock' sent by USBTMCDevice.close.
+                line = await reader.readline()
+                if not line: break
+                request = line.strip()
+
+                if request == b'lock':
+                    if not holding:
+                        await instrument.lock.acquire()
+                        holding = True
+                        instrument.discard()
+                    writer.write(b'locked')
+
+                elif request == b'unlock':
+                    if holding:
+                        instrument.lock.release()
+                        holding = False
+                    writer.write(b'unlocked')
+
+                elif request == b'read':
+                    response = await instrument.read() if holding else None
+                    writer.write(response if response is not None else b'read failed')
+
+                elif holding:
+                    # Anything still buffered answered an earlier write nobody read.
+                    instrument.discard()
+                    await instrument.write(line)
+
+                else:
+                    # Unlocked writes (e.g. set commands) go out between transactions.
+                    async with instrument.lock:
+                        await instrument.write(line)
+
+                await writer.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            if holding: instrument.lock.release()
+            writer.close()
+
+
+
+def parse_mapping(spec: str) -> Tuple[int, Instrument]:
+    """Parses '<local port>=<host>[:<tcp port>]'."""
+    port, address = spec.split('=')
+    host, _, tcp_port = address.partition(':')
+    return int(port), Instrument(host, int(tcp_port or 23))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('mappings', nargs='+', metavar='PORT=HOST[:TCP_PORT]',
+        help='Local port to serve and the instrument behind it, e.g. 5025=192.168.0.105:23')
+    args = parser.parse_args()
+
+    async def main():
+        # Instruments own asyncio primitives, so build them inside the loop.
+        multiplexer = Multiplexer(dict(parse_mapping(spec) for spec in args.mappings))
+        await multiplexer.serve_forever()
+
+    asyncio.run(main())
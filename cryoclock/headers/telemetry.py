@@ -0,0 +1,211 @@
+"""
+Always-on request telemetry for instrument connections.
+
+Each `USBTMCDevice` keeps a `DeviceStats`, with counters and latency
+histograms per command. Recording a sample is a few integer updates, so
+it stays on in production. Read it with `USBTMCDevice.stats()`, or write
+several devices to a Prometheus text-format file (e.g. for the
+node_exporter textfile collector) with `write_prometheus`.
+"""
+from typing import Dict, Iterable, List
+import math, os, re, threading
+
+
+# Histogram bucket upper bounds: 100 us, 200 us, ... doubling up to ~105 s.
+BUCKET_BASE = 1e-4 # seconds
+BUCKET_COUNT = 21
+BUCKET_BOUNDS = [BUCKET_BASE * 2**i for i in range(BUCKET_COUNT)]
+
+
+class LatencyHistogram:
+    """Counts of durations in power-of-two buckets, plus their sum and maximum."""
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (BUCKET_COUNT + 1) # The last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def observe(self, seconds: float) -> None:
+        # log2 gives the bucket directly, instead of searching the bounds.
+        # Buckets include their upper bound (Prometheus 'le'), so nudge
+        # the index where rounding put a value on the wrong side of one.
+        index = min(math.ceil(math.log2(seconds / BUCKET_BASE)), BUCKET_COUNT) if seconds > BUCKET_BASE else 0
+        if index and seconds <= BUCKET_BOUNDS[index - 1]: index -= 1
+        elif index < BUCKET_COUNT and seconds > BUCKET_BOUNDS[index]: index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile, but no more than the maximum."""
+        if not self.count: return math.nan
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKET_BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank: return min(bound, self.max)
+        return self.max
+
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else math.nan,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+
+class CommandStats:
+    """Counters and latencies for one command on one device."""
+
+    __slots__ = ('requests', 'retries', 'timeouts', 'errors', 'bytes_sent', 'bytes_received',
+                 'send', 'first_byte', 'response')
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.send = LatencyHistogram() # Writing the command
+        self.first_byte = LatencyHistogram() # Start of the request to the first byte of the response
+        self.response = LatencyHistogram() # Start of the request to the complete response
+
+
+    def snapshot(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'send': self.send.snapshot(),
+            'first_byte': self.first_byte.snapshot(),
+            'response': self.response.snapshot(),
+        }
+
+
+
+_ARGUMENT = re.compile(r'\s*(\+?=).*$')
+
+def command_key(command) -> str:
+    """
+    The name a command is counted under. Arguments are dropped, so
+    'In1.alarm.min = (10)' and 'In1.alarm.min = (20)' share 'In1.alarm.min ='.
+    """
+    if isinstance(command, (bytes, bytearray)):
+        command = bytes(command).decode('utf-8', errors='replace')
+    return _ARGUMENT.sub(r' \1', command.strip())
+
+
+
+class DeviceStats:
+    """All telemetry for one device."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.commands: Dict[str, CommandStats] = {}
+        self.reconnects = 0
+        self.unlock_failures = 0
+        self._lock = threading.Lock()
+
+
+    def command(self, command) -> CommandStats:
+        key = command_key(command)
+        stats = self.commands.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self.commands.setdefault(key, CommandStats())
+        return stats
+
+
+    def snapshot(self) -> dict:
+        totals = CommandStats()
+        for stats in list(self.commands.values()):
+            for field in ('requests', 'retries', 'timeouts', 'errors', 'bytes_sent', 'bytes_received'):
+                setattr(totals, field, getattr(totals, field) + getattr(stats, field))
+
+        return {
+            'device': self.name,
+            'reconnects': self.reconnects,
+            'unlock_failures': self.unlock_failures,
+            'totals': {field: value for field, value in totals.snapshot().items() if not isinstance(value, dict)},
+            'commands': {key: stats.snapshot() for key, stats in list(self.commands.items())},
+        }
+
+
+    def prometheus_lines(self) -> List[str]:
+        """Samples for this device, without HELP/TYPE headers."""
+        device = _label(self.name)
+        lines = [
+            f'usbtmc_reconnects_total{{device="{device}"}} {self.reconnects}',
+            f'usbtmc_unlock_failures_total{{device="{device}"}} {self.unlock_failures}',
+        ]
+        for key, stats in list(self.commands.items()):
+            labels = f'device="{device}",command="{_label(key)}"'
+            for field in ('requests', 'retries', 'timeouts', 'errors', 'bytes_sent', 'bytes_received'):
+                lines.append(f'usbtmc_{field}_total{{{labels}}} {getattr(stats, field)}')
+
+            for phase in ('send', 'first_byte', 'response'):
+                histogram = getattr(stats, phase)
+                cumulative = 0
+                for bound, count in zip(BUCKET_BOUNDS, histogram.buckets):
+                    cumulative += count
+                    lines.append(f'usbtmc_{phase}_seconds_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+                lines.append(f'usbtmc_{phase}_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'usbtmc_{phase}_seconds_sum{{{labels}}} {histogram.total}')
+                lines.append(f'usbtmc_{phase}_seconds_count{{{labels}}} {histogram.count}')
+        return lines
+
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_METRICS = [
+    ('reconnects_total', 'counter', 'Reconnections after failures.'),
+    ('unlock_failures_total', 'counter', 'Multiplexer unlocks that were not acknowledged.'),
+    ('requests_total', 'counter', 'Commands sent.'),
+    ('retries_total', 'counter', 'Multiplexer reads retried after "read failed".'),
+    ('timeouts_total', 'counter', 'Queries that got no response in time.'),
+    ('errors_total', 'counter', 'Requests that raised an I/O or protocol error.'),
+    ('bytes_sent_total', 'counter', 'Bytes written to the device.'),
+    ('bytes_received_total', 'counter', 'Bytes read from the device.'),
+    ('send_seconds', 'histogram', 'Time to write a command.'),
+    ('first_byte_seconds', 'histogram', 'Time from sending a query to the first byte of its response.'),
+    ('response_seconds', 'histogram', 'Time from sending a query to its complete response.'),
+]
+
+def write_prometheus(path: str, devices: Iterable) -> None:
+    """
+    Write the telemetry of `devices` (USBTMCDevice or DeviceStats objects)
+    to `path` in Prometheus text format. The file is replaced atomically,
+    so a scraper never sees it half-written.
+    """
+    samples = []
+    for device in devices:
+        stats = getattr(device, '_stats', device)
+        samples.extend(stats.prometheus_lines())
+
+    lines = []
+    for metric, kind, help_text in _METRICS:
+        name = f'usbtmc_{metric}'
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(line for line in samples if line.startswith((name + '{', name + '_bucket{', name + '_sum{', name + '_count{')))
+
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary, path)
@@ -0,0 +1,192 @@
+"""
+Plain TCP transport for LAN instruments.
+
+Replaces `telnetlib` (removed in Python 3.13). Received data goes into one
+preallocated buffer with `recv_into`, and responses are framed incrementally:
+bytes that have already been searched for the terminator are not searched
+again, and nothing is copied until a full response is handed to the caller.
+"""
+from typing import Optional
+import socket, time
+
+
+# Telnet command bytes, which some instruments send on their port 23.
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+
+
+class TCPTransport:
+    """A TCP connection with line framing over a reusable receive buffer."""
+
+    def __init__(self,
+            host: str,
+            port: int,
+            timeout: float = 5, # seconds
+            buffer_size: int = 65536,
+            telnet: bool = True,
+        ):
+        """
+        host, port:
+            Address of the instrument.
+
+        timeout: float
+            Default timeout for connecting and reading, in seconds.
+
+        buffer_size: int
+            Initial size of the receive buffer. It grows if a single
+            response doesn't fit.
+
+        telnet: bool
+            Strip telnet negotiation from received data, refusing every
+            option like `telnetlib` did.
+        """
+        self._timeout = timeout
+        self._telnet = telnet
+
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Disable Nagle's
+
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # First unread byte
+        self._end = 0 # End of received data
+        self._scan = 0 # Where the next terminator search starts
+
+        # When the first byte of the last `read_until` result was available (monotonic).
+        self.first_byte_at: Optional[float] = None
+
+
+    def fileno(self) -> int: return self._sock.fileno()
+
+
+    def close(self) -> None:
+        self._view.release()
+        self._sock.close()
+
+
+    def write(self, data: bytes) -> None:
+        self._sock.settimeout(self._timeout) # read_available may have left it non-blocking
+        self._sock.sendall(data)
+
+
+    ##### Buffer Management #####
+    def _consume(self, stop: int) -> None:
+        """Marks everything before `stop` as read."""
+        self._start = self._scan = stop
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+
+
+    def _make_room(self) -> None:
+        """Ensures there is free space at the end of the buffer."""
+        if self._end < len(self._buffer): return
+
+        unread = self._end - self._start
+        if self._start > 0:
+            # Move unread data to the front.
+            self._buffer[:unread] = bytes(self._view[self._start:self._end])
+        else:
+            # A single response is larger than the buffer.
+            self._view.release()
+            self._buffer.extend(bytes(len(self._buffer)))
+            self._view = memoryview(self._buffer)
+
+        self._scan -= self._start
+        self._start, self._end = 0, unread
+
+
+    def _fill(self, timeout: Optional[float]) -> int:
+        """Receives whatever has arrived (waiting up to `timeout`) into the buffer."""
+        self._make_room()
+        self._sock.settimeout(timeout)
+        received = self._sock.recv_into(self._view[self._end:])
+        if received == 0:
+            raise ConnectionError('Connection closed by the instrument.')
+        self._end += received
+        return received
+
+
+    def _take(self, stop: int) -> bytes:
+        data = bytes(self._view[self._start:stop])
+        self._consume(stop)
+        if self._telnet and IAC in data:
+            data = self._strip_telnet(data)
+        return data
+
+
+    def _strip_telnet(self, data: bytes) -> bytes:
+        """Removes telnet commands, refusing any option negotiation."""
+        out, i = bytearray(), 0
+        while i < len(data):
+            if data[i] != IAC:
+                out.append(data[i]); i += 1
+            elif i + 1 < len(data) and data[i + 1] == IAC:
+                out.append(IAC); i += 2
+            elif i + 2 < len(data) and data[i + 1] in (DO, DONT, WILL, WONT):
+                if data[i + 1] in (DO, WILL):
+                    self.write(bytes([IAC, WONT if data[i + 1] == DO else DONT, data[i + 2]]))
+                i += 3
+            elif i + 1 < len(data) and data[i + 1] == SB:
+                end = data.find(bytes([IAC, SE]), i)
+                i = len(data) if end < 0 else end + 2
+            else:
+                i += 2
+        return bytes(out)
+
+
+    ##### Reading #####
+    def read_until(self, terminator: bytes, timeout: Optional[float] = None) -> bytes:
+        """
+        Read until `terminator` arrives, and return everything up to and
+        including it. If `timeout` runs out first, return what has arrived.
+        """
+        deadline = time.monotonic() + (self._timeout if timeout is None else timeout)
+        self.first_byte_at = time.monotonic() if self._start < self._end else None
+
+        while True:
+            found = self._buffer.find(terminator, self._scan, self._end)
+            if found >= 0:
+                return self._take(found + len(terminator))
+
+            # Don't search the same bytes again, but allow for a terminator split across packets.
+            self._scan = max(self._start, self._end - len(terminator) + 1)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try:
+                self._fill(remaining)
+            except socket.timeout:
+                break
+            if self.first_byte_at is None: self.first_byte_at = time.monotonic()
+
+        return self._take(self._end)
+
+
+    def readinto(self, view: memoryview, timeout: Optional[float] = None) -> int:
+        """
+        Read up to `len(view)` bytes straight into `view`. Data that is
+        already buffered is copied out first; otherwise the socket writes
+        into `view` directly. Returns 0 if nothing arrives within `timeout`.
+        """
+        if self._start < self._end:
+            count = min(len(view), self._end - self._start)
+            view[:count] = self._view[self._start:self._start + count]
+            self._consume(self._start + count)
+            return count
+
+        self._sock.settimeout(self._timeout if timeout is None else timeout)
+        try:
+            received = self._sock.recv_into(view)
+        except socket.timeout:
+            return 0
+        if received == 0:
+            raise ConnectionError('Connection closed by the instrument.')
+        return received
+
+
+    def read_available(self) -> bytes:
+        """Return (and consume) everything that has arrived, without waiting."""
+        try:
+            while self._fill(0): pass
+        except (BlockingIOError, socket.timeout):
+            pass
+        return self._take(self._end)
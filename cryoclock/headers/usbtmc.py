@@ -1,10 +1,14 @@
-from typing import Optional, Union
+from typing import Dict, Iterator, List, Optional, Sequence, Union
 from typing_extensions import Literal
-import serial, time, telnetlib, itertools, os, socket, select, traceback
+import serial, time, os, socket, select, traceback, contextlib, collections, functools, threading
 
 import asyncio
 from colorama import Fore, Style
 
+from headers.transport import TCPTransport
+from headers.circuit_breaker import CircuitBreaker
+from headers.telemetry import DeviceStats
+
 
 ModeString = Union[Literal['serial'], Literal['ethernet'], Literal['direct'], Literal['multiplexed']]
 
@@ -12,6 +16,64 @@ DEBUG = False # Whether to print commands as they are sent
 DRY_RUN = False # If true, nothing actually happens (useful for debug)
 
 
+class RequestQueue:
+    """
+    A reentrant lock that is handed to waiting threads in the order they
+    asked for it, so requests to a shared device are served first come,
+    first served and a busy thread can't starve the others.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._waiters = collections.deque() # (thread id, event) in arrival order
+        self._owner = None
+        self._count = 0
+
+
+    def acquire(self) -> None:
+        me = threading.get_ident()
+        with self._mutex:
+            if self._owner == me:
+                self._count += 1
+                return
+            if self._owner is None:
+                self._owner, self._count = me, 1
+                return
+            turn = threading.Event()
+            self._waiters.append((me, turn))
+
+        # release() makes us the owner before setting the event.
+        turn.wait()
+
+
+    def release(self) -> None:
+        with self._mutex:
+            if self._owner != threading.get_ident():
+                raise RuntimeError('Cannot release a request queue held by another thread.')
+            self._count -= 1
+            if self._count: return
+
+            if self._waiters:
+                self._owner, turn = self._waiters.popleft()
+                self._count = 1
+                turn.set()
+            else:
+                self._owner = None
+
+
+    def __enter__(self): self.acquire()
+    def __exit__(self, exception_type, exception_value, traceback): self.release()
+
+
+def serialized(method):
+    """Run a `USBTMCDevice` method while holding the device's request queue."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._requests:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class USBTMCDevice:
     """The currently open connection."""
     _conn = None
@@ -22,6 +84,48 @@ class USBTMCDevice:
     """The name of this device."""
     _name: Optional[str] = None
 
+    """The byte sequence that ends every response from the device."""
+    read_termination: bytes = b'\n'
+
+    """The asyncio (reader, writer) stream pair, opened on first use."""
+    _async_conn = None
+
+    """
+    A query that only returns once the device has finished every earlier
+    command (e.g. '*OPC?'). Subclasses set this if the device supports one.
+    """
+    completion_query: Optional[str] = None
+
+    """Fixed delay after a write, used until the device's command gap has been measured."""
+    write_delay: float = 0.2
+
+    """Shortest measured query round trip (seconds), used to pace consecutive writes."""
+    _write_gap: Optional[float] = None
+
+    """Monotonic time before which the next write should not be sent."""
+    _ready_at: float = 0.0
+
+    """
+    How long (seconds) a response to each of these commands stays valid.
+    Queries for other commands always go to the device.
+    """
+    cache_ttl: Dict[str, float] = {}
+
+    """Query used to check that the device is back after a failure."""
+    probe_command: str = '*IDN?'
+
+    """Consecutive failures after which calls fail fast with `DeviceUnavailable`."""
+    failure_threshold: int = 3
+
+    """How many `transaction()` blocks are currently open."""
+    _transaction_depth: int = 0
+
+    """Serializes coroutines sharing the asyncio connection."""
+    _async_lock: Optional[asyncio.Lock] = None
+
+    """The event loop the asyncio connection and its lock belong to."""
+    _async_loop: Optional[asyncio.AbstractEventLoop] = None
+
 
     def __init__(self,
             resource_path: str,
@@ -58,21 +162,30 @@ class USBTMCDevice:
         if DRY_RUN:
             print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] Dry-run mode active. Nothing will actually happen.')
 
+        # One request at a time per connection, so that threads sharing
+        # this object always get back the response to their own command.
+        self._requests = RequestQueue()
+
         self._mode = mode
         self._resource_path = resource_path
         self._tcp_port = tcp_port
         self._timeout = timeout
+        self._cache = {} # (command, raw) -> (expiry, response)
+        self._breaker = CircuitBreaker(f'{resource_path}', self._reconnect, threshold=self.failure_threshold)
+        self._stats = DeviceStats(f'{resource_path}')
         self.connect()
 
         self._name = name or self.query('*IDN?')
+        self._breaker.name = self._stats.name = self.short_name
         print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Connected to {Style.RESET_ALL}{Style.BRIGHT}{self.name}{Style.RESET_ALL}')
 
 
+    @serialized
     def connect(self):
         """Opens the base-layer connection."""
         if self._mode == 'ethernet':
             print(f'Opening LAN connection on {self._resource_path}:{self._tcp_port}...')
-            self._conn = telnetlib.Telnet(self._resource_path, port=self._tcp_port, timeout=self._timeout)
+            self._conn = TCPTransport(self._resource_path, self._tcp_port, timeout=self._timeout)
 
         if self._mode == 'serial':
             print(f'Opening serial connection on {self._resource_path}...')
@@ -95,7 +208,7 @@ class USBTMCDevice:
                 self._conn.settimeout(self._timeout)
                 self._conn.connect(self._address)
             except:
-                print(f'{Fore.RED}Please start the multiplexer server!{Style.RESET_ALL}')
+                print(f'{Fore.RED}Please start the multiplexer server! (python -m headers.multiplexer {self._resource_path}=<host>:<port>){Style.RESET_ALL}')
                 self._conn = None
 
         time.sleep(0.1)
@@ -110,16 +223,70 @@ class USBTMCDevice:
         Closes the connection.
         Subclasses may override this to add additional cleanup behavior.
         """
+        self._breaker.stop()
+        self._disconnect()
+
+
+    @serialized
+    def _disconnect(self) -> None:
+        """Closes the connection without giving up on the device."""
         if self._mode == 'multiplexed':
             self._conn.send(b'unlock')
 
-            if self._async_conn is not None:
-                reader, writer = self._async_conn
-                writer.close()
-
+        self._forget_async()
         self._conn.close()
 
 
+    def _reconnect(self) -> None:
+        """Reopens the connection and checks that the device answers. Used by the circuit breaker."""
+        with self._requests:
+            try:
+                self._disconnect()
+            except Exception:
+                pass
+            self.connect()
+            self._stats.reconnects += 1
+            if self._exchange(self.probe_command, False, False, 2e-2, 65536) is None:
+                raise TimeoutError(f'No response to {self.probe_command}')
+
+
+    def stats(self) -> dict:
+        """
+        Request counters and latency summaries for this device, in total
+        and per command. See `headers.telemetry` for Prometheus export.
+        """
+        return self._stats.snapshot()
+
+
+    @property
+    def available(self) -> bool:
+        """False while the circuit breaker is open and calls fail fast."""
+        return not self._breaker.is_open
+
+
+    def _guarded(self, method, *args):
+        """
+        Call one of the I/O methods below, failing fast if the device is
+        unavailable and recording the outcome with the circuit breaker.
+        """
+        self._breaker.check()
+        with self._requests:
+            # Check again, in case the circuit opened while we were queued.
+            self._breaker.check()
+            try:
+                result = method(*args)
+            except (OSError, AssertionError, ValueError) as error:
+                self._stats.command(args[0]).errors += 1
+                self._breaker.failure(error)
+                raise
+
+        if (method == self._exchange and result is None) or (method == self._pipeline and None in result):
+            self._breaker.failure(TimeoutError(f'No response to {args[0]!r}'))
+        else:
+            self._breaker.success()
+        return result
+
+
     def __str__(self) -> str:
         """Default implementation. Override in subclasses."""
         return self.name
@@ -131,27 +298,92 @@ class USBTMCDevice:
 
     ##### Utility Functions #####
     def _clear_output(self) -> None:
-        """Clear any extraneous output that may show up in serial mode."""
+        """Clear any extraneous output that may show up in serial or ethernet mode."""
+        if self._mode == 'ethernet':
+            # Unread replies (e.g. to set commands) would otherwise be
+            # mistaken for the response to the next query.
+            extra = self._conn.read_available()
+            if extra and DEBUG: print('Extra Output:', extra)
+
         if self._mode != 'serial': return
         while self._conn.in_waiting > 0:
             print('Extra Output:', self._conn.readline())
 
 
-    def send_command(self, command: str, raw: bool = False, delay: float = 0.2) -> None:
-        """Send a command to the device."""
+    def _pace_delay(self) -> float:
+        """How long to wait before the next write, given the pacing of the last one."""
+        return max(0.0, self._ready_at - time.monotonic())
+
+
+    def _settle(self, delay: Optional[float]) -> None:
+        """
+        Wait after a write until the device can take the next command.
+
+        An explicit `delay` is slept as-is. Otherwise the device's completion
+        query is used if it has one; failing that, the next write is held back
+        by the measured command gap, and the fixed `write_delay` is only used
+        until a gap has been measured.
+        """
+        if delay is not None:
+            time.sleep(delay)
+        elif self.completion_query is not None:
+            self._exchange(self.completion_query, False, False, 0, 65536)
+        elif self._write_gap is not None:
+            self._ready_at = time.monotonic() + self._write_gap
+        else:
+            time.sleep(self.write_delay)
+
+
+    def _note_round_trip(self, seconds: float) -> None:
+        """Record a query round trip, tightening the measured command gap."""
+        if self._write_gap is None or seconds < self._write_gap:
+            self._write_gap = seconds
+
+
+    def send_command(self, command: str, raw: bool = False, delay: Optional[float] = None) -> None:
+        """
+        Send a command to the device.
+
+        delay: float
+            Fixed delay after writing. By default, writes are paced by
+            completion instead (see `_settle`).
+
+        Raises `DeviceUnavailable` without waiting if the device has
+        failed repeatedly and is being reconnected in the background.
+        """
+        if DRY_RUN:
+            if DEBUG: print(f'  [{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} <{Style.RESET_ALL} {Fore.RED}{command}{Style.RESET_ALL}')
+            return
+        self._guarded(self._send, command, raw, delay)
+
+
+    def _send(self, command: str, raw: bool, delay: Optional[float]) -> None:
+        """Performs the I/O for `send_command`."""
         if DEBUG: print(f'  [{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} <{Style.RESET_ALL} {Fore.RED}{command}{Style.RESET_ALL}')
         if DRY_RUN: return
 
         if not raw:
             command = (command + '\n').encode('utf-8')
 
+        time.sleep(self._pace_delay())
+
+        stats = self._stats.command(command)
+        stats.requests += 1
+        stats.bytes_sent += len(command)
+        start = time.monotonic()
+
         if self._mode == 'multiplexed':
             self._conn.send(command)
-
-            # unless you read after, a 0.2 s
-            # delay is necessary because of
-            # TCP packet scheduling voodoo magic
-            time.sleep(delay)
+            stats.send.observe(time.monotonic() - start)
+
+            # unless you read after, the device
+            # needs time to take the command because
+            # of TCP packet scheduling voodoo magic.
+            # Inside a transaction too: the multiplexer
+            # discards unread output before each write,
+            # so a reply that comes late would otherwise
+            # be read as the next query's response.
+            self._settle(delay)
             return
 
         self._clear_output()
@@ -159,7 +391,10 @@ class USBTMCDevice:
 
         if self._mode in ['serial', 'direct']:
             self._conn.flush()
-            time.sleep(delay)
+            stats.send.observe(time.monotonic() - start)
+            self._settle(delay)
+        else:
+            stats.send.observe(time.monotonic() - start)
 
 
     def query(
@@ -182,73 +417,579 @@ class USBTMCDevice:
         delay: float
             Delay between writing the command and reading the response.
             Increase the delay for commands that return large amounts of data.
+
+        Returns None if the device doesn't answer in time. Raises
+        `DeviceUnavailable` without waiting if the device has failed
+        repeatedly and is being reconnected in the background.
         """
         if DRY_RUN:
             self.send_command(command, raw=raw_command, delay=0)
             return None
 
+        ttl = self.cache_ttl.get(command)
+        if ttl is None:
+            return self._guarded(self._exchange, command, raw, raw_command, delay, max_size)
+
+        key = (command, raw)
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+
+        response = self._guarded(self._exchange, command, raw, raw_command, delay, max_size)
+        if response is not None:
+            self._cache[key] = (time.monotonic() + ttl, response)
+        return response
+
+
+    def invalidate(self, *commands: str) -> None:
+        """
+        Drop cached responses to the given commands (case-insensitive),
+        or every cached response if none are given.
+        """
+        if not commands:
+            self._cache.clear()
+            return
+
+        commands = {command.lower() for command in commands}
+        for key in [key for key in self._cache if key[0].lower() in commands]:
+            del self._cache[key]
+
+
+    def _exchange(self, command: str, raw: bool, raw_command: bool, delay: float, max_size: int) -> Union[str, bytes]:
+        """Performs the I/O for `query`, bypassing the cache."""
+        stats = self._stats.command(command)
+        start = time.monotonic()
         if self._mode != 'multiplexed':
-            self.send_command(command, raw=raw_command, delay=delay)
+            self._send(command, raw_command, delay)
 
         if self._mode == 'ethernet':
-            for tries in itertools.count(1):
-                response = self._conn.read_very_eager()
-                if response: break
-                time.sleep(0.2)
-                if tries > 30: return None
+            # Block on the socket until the terminator arrives, so a query
+            # costs one round trip instead of a polling interval.
+            response = self._conn.read_until(self.read_termination, timeout=self._timeout)
+            first_byte = self._conn.first_byte_at
+            if not response.endswith(self.read_termination):
+                stats.timeouts += 1
+                return None
 
         if self._mode == 'direct':
             # We use os.read to prevent blocking.
             response = os.read(self._conn.fileno(), max_size)
+            first_byte = time.monotonic()
 
         if self._mode == 'serial':
             # To avoid blocking and improve debugging,
             # we wait explicitly for input.
-            for tries in itertools.count(1):
-                time.sleep(0.2)
-                if self._conn.in_waiting: break
-                if tries > 30: return None
-
+            deadline = time.monotonic() + self._timeout
+            while not self._conn.in_waiting:
+                if time.monotonic() > deadline:
+                    stats.timeouts += 1
+                    return None
+                time.sleep(1e-3)
+
+            first_byte = time.monotonic()
             response = self._conn.readline()
 
         if self._mode == 'multiplexed':
-            # Acquire lock
-            self._conn.send(b'lock\n')
-            assert self._conn.recv(32) == b'locked'
+            with self.transaction():
+                # The multiplexer holds each read until the device
+                # has answered, so no delay is needed after sending.
+                self._send(command, raw_command, 0)
+
+                for i in range(20):
+                    self._conn.send(b'read\n')
+                    response = self._conn.recv(max_size)
+                    if response != b'read failed': break
+                    if DEBUG:
+                        print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} :{Style.RESET_ALL} {Fore.BLUE}Read failed, trying again.{Style.RESET_ALL}')
+                else:
+                    stats.retries += i
+                    stats.timeouts += 1
+                    raise ValueError('Read failed too many times.')
+
+                stats.retries += i
+                first_byte = time.monotonic()
+
+        finish = time.monotonic()
+        stats.first_byte.observe((first_byte or finish) - start)
+        stats.response.observe(finish - start)
+        stats.bytes_received += len(response)
+        self._note_round_trip(finish - start)
+
+        if DEBUG: print(f'  [{Fore.GREEN}RECV{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} >{Style.RESET_ALL} {Fore.GREEN}{response[:50]}{Style.RESET_ALL}')
+
+        # Decode the response to a Python string if raw == False.
+        return response if raw else response.decode('utf-8').strip()
+
+
+
+
+    def query_many(self, commands: Sequence[str], raw: bool = False) -> List[Union[str, bytes, None]]:
+        """
+        Send several queries and return their responses in order (None for
+        any that got no response in time).
+
+        Over ethernet and serial the commands are pipelined: they go out in
+        one write and the responses are read back-to-back, so a long series
+        of queries costs about one round trip. Other modes run the queries
+        one by one inside a single `transaction()`.
+        """
+        if DRY_RUN or self._mode not in ('ethernet', 'serial'):
+            with self.transaction():
+                return [self.query(command, raw=raw) for command in commands]
+
+        return self._guarded(self._pipeline, '<pipelined>', commands, raw)
+
+
+    def _pipeline(self, label: str, commands: Sequence[str], raw: bool) -> List[Union[str, bytes, None]]:
+        """Performs the I/O for `query_many`."""
+        stats = self._stats.command(label)
+        data = b''.join((command + '\n').encode('utf-8') for command in commands)
+        stats.requests += len(commands)
+        stats.bytes_sent += len(data)
+
+        time.sleep(self._pace_delay())
+        start = time.monotonic()
+        self._clear_output()
+        self._conn.write(data)
+        if self._mode == 'serial': self._conn.flush()
+        stats.send.observe(time.monotonic() - start)
+
+        responses = []
+        for command in commands:
+            if self._mode == 'ethernet':
+                response = self._conn.read_until(self.read_termination, timeout=self._timeout)
+            else:
+                response = self._conn.readline() # Bounded by the serial timeout
+
+            if not response.endswith(self.read_termination):
+                # The rest are stuck behind this one; don't wait for each.
+                stats.timeouts += 1
+                responses += [None] * (len(commands) - len(responses))
+                break
+
+            if not responses: stats.first_byte.observe(time.monotonic() - start)
+            stats.bytes_received += len(response)
+            responses.append(response if raw else response.decode('utf-8').strip())
+
+        stats.response.observe(time.monotonic() - start)
+        return responses
+
+
+
+    ##### Binary Block Transfers #####
+    def _readinto(self, view: memoryview) -> int:
+        """Read up to `len(view)` bytes into `view`, returning how many arrived."""
+        if self._mode == 'ethernet':
+            return self._conn.readinto(view)
+        if self._mode == 'direct':
+            # Bypass the buffered file object, as `query` does with os.read.
+            return self._conn.raw.readinto(view)
+        if self._mode == 'serial':
+            return self._conn.readinto(view)
+        raise ValueError(f'Binary block transfers are not supported in {self._mode} mode.')
+
+
+    def _read_exact(self, view: memoryview) -> None:
+        """Fill `view` completely."""
+        filled = 0
+        while filled < len(view):
+            received = self._readinto(view[filled:])
+            if not received:
+                raise TimeoutError(f'{self.short_name}: binary block ended after {filled} of {len(view)} bytes.')
+            filled += received
+
+
+    def _read_block_header(self) -> int:
+        """Read an IEEE-488.2 definite-length block header (#<n><len>) and return <len>."""
+        byte = bytearray(1)
+        view = memoryview(byte)
+
+        # Skip anything (e.g. whitespace) before the '#'.
+        while True:
+            self._read_exact(view)
+            if byte == b'#': break
+
+        self._read_exact(view)
+        if not byte.isdigit() or byte == b'0':
+            raise ValueError(f'{self.short_name}: expected a definite-length block, got header #{byte.decode(errors="replace")}.')
+
+        digits = bytearray(int(byte))
+        self._read_exact(memoryview(digits))
+        return int(digits)
+
+
+    def _read_block_trailer(self) -> None:
+        """Consume the response terminator that follows a block."""
+        self._read_exact(memoryview(bytearray(len(self.read_termination))))
+
+
+    @serialized
+    def query_block(self, command: str, out=None, dtype=None):
+        """
+        Send a command whose response is an IEEE-488.2 definite-length
+        block (#<n><len><data>), and read the data without decoding it.
+
+        out:
+            A writable, contiguous buffer to read into (bytearray, NumPy
+            array, ...). It must be at least as large as the block.
+
+        dtype:
+            If given and `out` is not, a NumPy array of this dtype is
+            allocated to fit the block and returned.
+
+        Returns a memoryview of the filled part of `out`, the new NumPy
+        array if `dtype` was given, or a bytearray otherwise.
+        """
+        if DRY_RUN:
+            self.send_command(command, delay=0)
+            return None
+
+        self.send_command(command, delay=0)
+        length = self._read_block_header()
+
+        if out is None and dtype is not None:
+            import numpy as np
+            dtype = np.dtype(dtype)
+            if length % dtype.itemsize:
+                raise ValueError(f'{self.short_name}: block of {length} bytes is not a whole number of {dtype}.')
+            result = np.empty(length // dtype.itemsize, dtype=dtype)
+            view = memoryview(result).cast('B')
+        elif out is None:
+            result = bytearray(length)
+            view = memoryview(result)
+        else:
+            view = memoryview(out).cast('B')
+            if len(view) < length:
+                raise ValueError(f'{self.short_name}: block of {length} bytes does not fit in a {len(view)} byte buffer.')
+            view = result = view[:length]
+
+        self._read_exact(view)
+        self._read_block_trailer()
+
+        if DEBUG: print(f'  [{Fore.GREEN}RECV{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} >{Style.RESET_ALL} {Fore.GREEN}<{length} byte block>{Style.RESET_ALL}')
+        return result
+
+
+    def iter_block(self, command: str, chunk_size: int = 65536) -> Iterator[memoryview]:
+        """
+        Send a command whose response is a definite-length block, and
+        stream the data in chunks. The chunks share one buffer, so each
+        must be used (or copied) before asking for the next::
+
+            >>> with open('waveform.bin', 'wb') as f:
+            ...     for chunk in scope.iter_block(':WAV:DATA?'):
+            ...         f.write(chunk)
+        """
+        with self._requests:
+            self.send_command(command, delay=0)
+            remaining = self._read_block_header()
+
+            buffer = memoryview(bytearray(min(chunk_size, remaining)))
+            while remaining:
+                received = self._readinto(buffer[:min(len(buffer), remaining)])
+                if not received:
+                    raise TimeoutError(f'{self.short_name}: binary block ended with {remaining} bytes left.')
+                remaining -= received
+                yield buffer[:received]
+
+            self._read_block_trailer()
+
+
+
+    ##### Multiplexer Transactions #####
+    def _lock(self) -> None:
+        """Acquire the multiplexer lock."""
+        self._conn.send(b'lock\n')
+        assert self._conn.recv(32) == b'locked'
+
+
+    def _unlock(self) -> None:
+        """Release the multiplexer lock."""
+        self._conn.send(b'unlock\n')
+        try:
+            assert self._conn.recv(32) == b'unlocked'
+        except (AssertionError, socket.timeout):
+            # Force close connection if failed to unlock
+            self._stats.unlock_failures += 1
+            self._disconnect()
+            self.connect()
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Hold the multiplexer lock across several commands, so that reading
+        many values costs one lock handshake instead of one per value::
+
+            >>> with c.transaction():
+            ...     values = [c.read(channel) for channel in c.channels]
+
+        Transactions may be nested. Other threads using this object wait
+        until the transaction ends. Outside multiplexed mode that is all
+        this does.
+
+        Each command still waits for the device before the next one goes
+        out: queries for their response, set commands as in `send_command`.
+        A device that acknowledges set commands should have them sent with
+        `query` (as CTC100 does at High verbosity), so the reply is read.
+        """
+        with self._requests:
+            locking = self._mode == 'multiplexed' and not self._transaction_depth and not DRY_RUN
+            if locking: self._lock()
+            self._transaction_depth += 1
+            try:
+                yield self
+            finally:
+                self._transaction_depth -= 1
+                if locking: self._unlock()
+
+
+
+    ##### Asynchronous Interface #####
+    def _get_async_lock(self) -> asyncio.Lock:
+        """
+        The lock serializing coroutines on the asyncio connection, made
+        once per event loop. Streams and locks only work on the loop they
+        were made on, so a new loop (e.g. a second `asyncio.run`) starts
+        over with its own.
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_lock is None or loop is not self._async_loop:
+            self._forget_async()
+            self._async_lock = asyncio.Lock()
+            self._async_loop = loop
+        return self._async_lock
+
+
+    def _forget_async(self) -> None:
+        """Drops the asyncio connection without awaiting anything, from any thread."""
+        conn, loop = self._async_conn, self._async_loop
+        self._async_conn = None
+        if conn is None or loop is None or loop.is_closed(): return # Nothing left to close it with
+
+        reader, writer = conn
+        if loop.is_running():
+            loop.call_soon_threadsafe(writer.close)
+        else:
+            writer.close()
+
+
+    async def aconnect(self) -> None:
+        """
+        Opens an asyncio stream connection alongside the blocking one, if
+        it isn't open yet. Only available in ethernet and multiplexed modes.
+        """
+        async with self._get_async_lock():
+            if self._async_conn is None:
+                await self._aopen()
+
+
+    async def _aopen(self) -> None:
+        """Opens the asyncio connection. Call with the async lock held."""
+        if self._mode == 'ethernet':
+            address = (self._resource_path, self._tcp_port)
+        elif self._mode == 'multiplexed':
+            address = self._address
+        else:
+            raise ValueError(f'Asynchronous I/O is not supported in {self._mode} mode.')
+
+        self._async_conn = await asyncio.wait_for(asyncio.open_connection(*address), self._timeout)
+
+
+    async def aclose(self) -> None:
+        """Closes the asyncio connection, if open."""
+        async with self._get_async_lock():
+            await self._adrop()
+
+
+    async def _adrop(self) -> None:
+        """
+        Closes the asyncio connection without taking the lock, e.g. because
+        a late reply is still on its way and would be read as the answer
+        to the next query. The next request reopens it.
+        """
+        if self._async_conn is None: return
+        reader, writer = self._async_conn
+        self._async_conn = None
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+
+
+    async def _aguarded(self, method, *args):
+        """Coroutine version of `_guarded`; also (re)opens the connection as needed."""
+        self._breaker.check()
+        async with self._get_async_lock():
+            self._breaker.check()
+            try:
+                if self._async_conn is None: await self._aopen()
+                result = await method(*args)
+            except (OSError, AssertionError, ValueError, asyncio.TimeoutError) as error:
+                self._stats.command(args[0]).errors += 1
+                self._breaker.failure(error)
+                await self._adrop() # Its state is unknown now
+                raise
+
+        if method == self._aexchange and result is None:
+            self._breaker.failure(TimeoutError(f'No response to {args[0]!r}'))
+        else:
+            self._breaker.success()
+        return result
+
+
+    async def _aclear_output(self) -> None:
+        """
+        Async version of `_clear_output`: drop whatever is already buffered,
+        e.g. replies to set commands. StreamReader has no non-blocking read,
+        so start one, let it run once, and cancel it if it had to wait.
+        """
+        reader, writer = self._async_conn
+        while True:
+            pending = asyncio.ensure_future(reader.read(65536))
+            await asyncio.sleep(0)
+            if not pending.done():
+                pending.cancel()
+                try:
+                    await pending
+                except asyncio.CancelledError:
+                    pass
+                return
+
+            extra = pending.result()
+            if not extra: return # EOF
+            if DEBUG: print('Extra Output:', extra)
+
+
+    async def _awrite(self, data: bytes) -> None:
+        reader, writer = self._async_conn
+        writer.write(data)
+        await writer.drain()
+
+
+    async def _aread(self, max_size: int) -> bytes:
+        reader, writer = self._async_conn
+        return await asyncio.wait_for(reader.read(max_size), self._timeout)
+
+
+    async def asend_command(self, command: str, raw: bool = False, delay: Optional[float] = None) -> None:
+        """Coroutine version of `send_command`."""
+        if DEBUG: print(f'  [{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} <{Style.RESET_ALL} {Fore.RED}{command}{Style.RESET_ALL}')
+        if DRY_RUN: return
+        await self._aguarded(self._asend, command, raw, delay)
+
+
+    async def _asend(self, command: str, raw: bool, delay: Optional[float]) -> None:
+        """Performs the I/O for `asend_command`."""
+        if not raw:
+            command = (command + '\n').encode('utf-8')
+
+        await asyncio.sleep(self._pace_delay())
+
+        stats = self._stats.command(command)
+        stats.requests += 1
+        stats.bytes_sent += len(command)
+        start = time.monotonic()
+
+        if self._mode == 'ethernet':
+            await self._aclear_output()
+        await self._awrite(command)
+        stats.send.observe(time.monotonic() - start)
+
+        if self._mode == 'multiplexed':
+            if delay is not None:
+                await asyncio.sleep(delay)
+            elif self._write_gap is not None:
+                self._ready_at = time.monotonic() + self._write_gap
+            else:
+                await asyncio.sleep(self.write_delay)
+
+
+    async def aquery(
+        self,
+        command: str,
+        raw: bool = False,
+        raw_command: bool = False,
+        delay: float = 2e-2,
+        max_size: int = 65536,
+    ) -> Union[str, bytes]:
+        """
+        Coroutine version of `query`, with the same cache, circuit breaker
+        and telemetry. Only the waiting is asynchronous, so many devices
+        can be queried concurrently from one event loop, e.g.::
+
+            >>> await asyncio.gather(*(d.aquery('*IDN?') for d in devices))
+
+        Concurrent queries on one device take turns on its connection.
+        """
+        if DRY_RUN:
+            await self.asend_command(command, raw=raw_command, delay=0)
+            return None
+
+        ttl = self.cache_ttl.get(command)
+        if ttl is None:
+            return await self._aguarded(self._aexchange, command, raw, raw_command, delay, max_size)
+
+        key = (command, raw)
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+
+        response = await self._aguarded(self._aexchange, command, raw, raw_command, delay, max_size)
+        if response is not None:
+            self._cache[key] = (time.monotonic() + ttl, response)
+        return response
+
+
+    async def _aexchange(self, command: str, raw: bool, raw_command: bool, delay: float, max_size: int) -> Union[str, bytes]:
+        """Performs the I/O for `aquery`, bypassing the cache."""
+        if DEBUG: print(f'  [{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} <{Style.RESET_ALL} {Fore.RED}{command}{Style.RESET_ALL}')
+        stats = self._stats.command(command)
+        reader, writer = self._async_conn
+        start = time.monotonic()
+
+        if self._mode == 'ethernet':
+            await self._asend(command, raw_command, delay)
+            try:
+                response = await asyncio.wait_for(reader.readuntil(self.read_termination), self._timeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                stats.timeouts += 1
+                await self._adrop() # Or its late reply would answer the next query
+                return None
+
+        if self._mode == 'multiplexed':
+            # Same lock/read/unlock protocol as the blocking path.
+            await self._awrite(b'lock\n')
+            assert await self._aread(32) == b'locked'
 
-            # Send command and wait for device response
-            self.send_command(command, raw=raw_command, delay=delay)
+            await self._asend(command, raw_command, delay=0)
 
-            # Read response
             for i in range(20):
-                self._conn.send(b'read\n')
-                response = self._conn.recv(max_size)
+                await self._awrite(b'read\n')
+                response = await self._aread(max_size)
                 if response != b'read failed': break
-                time.sleep(5e-2)
-                if DEBUG:
-                    print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} :{Style.RESET_ALL} {Fore.BLUE}Read failed, trying again.{Style.RESET_ALL}')
             else:
+                stats.retries += i
+                stats.timeouts += 1
                 raise ValueError('Read failed too many times.')
+            stats.retries += i
 
-            # Release lock
-            time.sleep(1e-3)
-            self._conn.send(b'unlock\n')
-            try:
-                assert self._conn.recv(32) == b'unlocked'
-            except (AssertionError, socket.timeout):
-                # Force close connection if failed to unlock
-                self.close()
-                self.connect()
+            await self._awrite(b'unlock\n')
+            assert await self._aread(32) == b'unlocked'
+
+        finish = time.monotonic()
+        stats.first_byte.observe(finish - start) # The stream doesn't tell us when the first byte came
+        stats.response.observe(finish - start)
+        stats.bytes_received += len(response)
+        self._note_round_trip(finish - start)
 
         if DEBUG: print(f'  [{Fore.GREEN}RECV{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} >{Style.RESET_ALL} {Fore.GREEN}{response[:50]}{Style.RESET_ALL}')
 
-        # Decode the response to a Python string if raw == False.
         return response if raw else response.decode('utf-8').strip()
 
 
 
-
-
     ##### Context Manager Magic Methods #####
     def __enter__(self): return self
     def __exit__(self, exception_type, exception_value, traceback): self.close()
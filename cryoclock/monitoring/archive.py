@@ -0,0 +1,236 @@
+"""
+Append-only binary archive of monitor samples.
+
+Each local day goes into a segment file, YYYY-MM-DD.arc, of fixed-width
+records: a float64 time (seconds since the epoch) and one float32 (or
+float64) per channel, little-endian. A short header in front holds the
+channel names, so a reader maps the whole file as a NumPy structured
+array without parsing anything::
+
+    >>> data = read_archive('archive', start=time.time() - 30 * 86400)
+    >>> data['Time'], data['4K cyl']
+
+File layout: the magic b'CRYOARC1', a little-endian uint32 header length
+N, then N bytes of JSON ({"channels": [...], "dtype": "<f4"}) padded with
+spaces so the records start on a 64-byte boundary.
+"""
+from typing import Iterable, List, Optional, Sequence
+from datetime import datetime, timedelta
+import json, os, struct, time
+
+MAGIC = b'CRYOARC1'
+SUFFIX = '.arc'
+_ALIGN = 64
+
+
+def record_dtype(channels: Sequence[str], dtype: str = '<f4'):
+    import numpy as np
+    return np.dtype([('Time', '<f8')] + [(channel, dtype) for channel in channels])
+
+
+def _header(channels: Sequence[str], dtype: str) -> bytes:
+    text = json.dumps({'channels': list(channels), 'dtype': dtype}).encode()
+    length = -(-(len(MAGIC) + 4 + len(text)) // _ALIGN) * _ALIGN - len(MAGIC) - 4
+    return MAGIC + struct.pack('<I', length) + text.ljust(length)
+
+
+def read_header(path: str):
+    """Returns (channels, dtype, offset of the first record)."""
+    with open(path, 'rb') as file:
+        start = file.read(len(MAGIC) + 4)
+        if len(start) < len(MAGIC) + 4 or start[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a monitor archive segment.')
+        length, = struct.unpack('<I', start[len(MAGIC):])
+        header = json.loads(file.read(length))
+    return header['channels'], header['dtype'], len(MAGIC) + 4 + length
+
+
+
+class ArchiveWriter:
+
+    def __init__(self,
+            directory: str,
+            columns: Sequence[str],
+            dtype: str = '<f4',
+            flush_rows: int = 60,
+            flush_interval: float = 10.0, # seconds
+            fsync_interval: float = 60.0, # seconds
+        ):
+        """
+        directory: str
+            Where the segment files go. Created if needed.
+
+        columns: list of str
+            'Time' first, then the channels; the same rows DailyCSVWriter
+            takes, so both can sit behind a BackgroundWriter.
+
+        dtype: str
+            '<f4' (float32, plenty for 4-figure temperatures) or '<f8'.
+
+        flush_rows, flush_interval, fsync_interval:
+            As for DailyCSVWriter.
+        """
+        self.directory = directory
+        self.channels = list(columns[1:])
+        self.dtype = dtype
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._record = struct.Struct('<d' + {'<f4': 'f', '<f8': 'd'}[dtype] * len(self.channels))
+        self.path: Optional[str] = None
+        self._file = None
+        self._day_start = self._day_end = 0.0
+        self._pending = 0
+        self._flushed_at = self._synced_at = time.monotonic()
+
+
+    def write(self, row: Sequence) -> None:
+        """Append one sample, aligned with `columns`. None is stored as NaN."""
+        t = row[0]
+        if self._file is None or not self._day_start <= t < self._day_end:
+            self._open(t)
+
+        self._file.write(self._record.pack(*(float('nan') if value is None else value for value in row)))
+        self._pending += 1
+
+        now = time.monotonic()
+        if self._pending >= self.flush_rows or now - self._flushed_at >= self.flush_interval:
+            self.flush(now)
+
+
+    def flush(self, now: Optional[float] = None) -> None:
+        if self._file is None: return
+        now = time.monotonic() if now is None else now
+
+        self._file.flush()
+        self._pending = 0
+        self._flushed_at = now
+        if self.fsync_interval is not None and now - self._synced_at >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._synced_at = now
+
+
+    def close(self) -> None:
+        if self._file is None: return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = self.path = None
+
+
+    def _open(self, t: float) -> None:
+        self.close()
+
+        day = datetime.fromtimestamp(t).replace(hour=0, minute=0, second=0, microsecond=0)
+        self._day_start = day.timestamp()
+        self._day_end = (day + timedelta(days=1)).timestamp()
+
+        # A day whose channels changed part way through continues in YYYY-MM-DD.1.arc, etc.
+        # Only the day's latest segment is reused, so the numbering follows time.
+        stem = day.strftime('%Y-%m-%d')
+        def segment(n): return os.path.join(self.directory, f'{stem}.{n}{SUFFIX}' if n else f'{stem}{SUFFIX}')
+        n = 0
+        while os.path.exists(segment(n + 1)): n += 1
+        path = segment(n)
+        if os.path.exists(path) and os.path.getsize(path) > 0 and read_header(path)[:2] != (self.channels, self.dtype):
+            path = segment(n + 1)
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self._file = open(path, 'wb', buffering=1 << 16)
+            self._file.write(_header(self.channels, self.dtype))
+        else:
+            self._file = open(path, 'r+b', buffering=1 << 16)
+            self._file.truncate(self._complete_size(path)) # Drop a record torn by a crash
+            self._file.seek(0, os.SEEK_END)
+
+        self.path = path
+        self._synced_at = time.monotonic()
+
+
+    def _complete_size(self, path: str) -> int:
+        offset = read_header(path)[2]
+        size = self._record.size
+        return offset + (os.path.getsize(path) - offset) // size * size
+
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc) -> None: self.close()
+
+
+
+##### Reading #####
+def open_segment(path: str):
+    """
+    Map a segment file as a read-only structured array, without reading
+    it. Safe while the file is being appended to; records written after
+    the call aren't included.
+    """
+    import numpy as np
+
+    channels, dtype, offset = read_header(path)
+    dtype = record_dtype(channels, dtype)
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if count == 0: return np.zeros(0, dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+def segments(directory: str, start: Optional[float] = None, end: Optional[float] = None) -> List[str]:
+    """The segment files in `directory` that may hold samples between `start` and `end`, oldest first."""
+    first = datetime.fromtimestamp(start).strftime('%Y-%m-%d') if start is not None else ''
+    last = datetime.fromtimestamp(end).strftime('%Y-%m-%d') if end is not None else '9999'
+    names = [name for name in os.listdir(directory) if name.endswith(SUFFIX) and first <= name[:10] <= last]
+    return [os.path.join(directory, name) for name in sorted(names, key=lambda name: (name[:10], len(name), name))]
+
+
+def read_archive(directory: str, start: Optional[float] = None, end: Optional[float] = None, channels: Optional[Iterable[str]] = None):
+    """
+    Load the samples between `start` and `end` (seconds since the epoch;
+    default: everything) as one structured array with fields 'Time' and
+    the channels (default: those of the segment with the latest sample),
+    stored as in that segment, sorted by time. Channels a segment
+    doesn't have are NaN.
+    """
+    import numpy as np
+
+    paths = segments(directory, start, end)
+    datas = []
+    for path in paths:
+        data = open_segment(path)
+        if start is not None or end is not None:
+            times = data['Time']
+            keep = slice(
+                np.searchsorted(times, start, 'left') if start is not None else 0,
+                np.searchsorted(times, end, 'right') if end is not None else len(data),
+            )
+            data = data[keep]
+        datas.append(data)
+
+    latest = max((data for data in datas if len(data)), key=lambda data: data['Time'][-1], default=None)
+    if latest is None and datas: latest = datas[-1]
+    if latest is not None:
+        newest = list(latest.dtype.names[1:])
+        value_dtype = latest.dtype[1].str if newest else '<f8'
+    else:
+        newest, value_dtype = [], '<f8'
+    dtype = record_dtype(newest if channels is None else list(channels), value_dtype)
+
+    parts = []
+    for data in datas:
+        if data.dtype == dtype:
+            parts.append(data)
+            continue
+        part = np.empty(len(data), dtype)
+        for name in dtype.names:
+            part[name] = data[name] if name in data.dtype.names else np.nan
+        parts.append(part)
+
+    if not parts: return np.zeros(0, dtype)
+    result = np.concatenate(parts)
+    times = result['Time']
+    if len(parts) > 1 and np.any(times[1:] < times[:-1]):
+        # Segments written before a day's numbering followed time can interleave.
+        result = result[np.argsort(times, kind='stable')]
+    return result
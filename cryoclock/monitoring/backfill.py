@@ -0,0 +1,137 @@
+"""
+Merge samples recovered from an instrument's internal log into the
+daily monitor CSV files written by run_monitors.py.
+
+Samples that fall within `tolerance` seconds of a row that is already in
+the file are skipped, so backfilling the same stretch twice, or a stretch
+that was partly recorded live, never duplicates data. Rows logged with
+the instrument's channels empty during the outage are filled in instead.
+"""
+from typing import Dict, List, Sequence
+from datetime import datetime
+import bisect, csv, math, os
+
+
+def _is_number(text: str) -> bool:
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def _daily_path(directory: str, timestamp: float, columns: Sequence[str]) -> str:
+    """
+    The file run_monitors.py writes a sample taken at `timestamp` to:
+    YYYY-MM-DD.csv, or YYYY-MM-DD.1.csv, .2.csv, ... once the columns
+    have changed that day. Only the day's latest file is reused, and
+    only if its header is `columns`.
+    """
+    stem = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+    def segment(n): return os.path.join(directory, f'{stem}.{n}.csv' if n else f'{stem}.csv')
+
+    n = 0
+    while os.path.exists(segment(n + 1)): n += 1
+    path = segment(n)
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, newline='') as file:
+            first = next(csv.reader(file), [])
+        if first and first != list(columns) and not _is_number(first[0]):
+            path = segment(n + 1)
+    return path
+
+
+def backfill_csv(path: str, columns: Sequence[str], times, values: Dict[str, Sequence[float]], tolerance: float) -> int:
+    """
+    Merge samples into one CSV file, keeping its rows sorted by time.
+
+    columns: the file's columns, 'Time' first and then channel names.
+    times: sample times (seconds since the epoch).
+    values: each channel's samples, aligned with `times`. Channels that
+        are missing, and NaN samples, are left empty.
+
+    Rows where all of `values`' channels are empty (written while the
+    instrument was unreachable) are filled in place rather than counted
+    as existing.
+
+    Returns the number of rows added or filled.
+    """
+    header, rows = None, []
+    if os.path.exists(path):
+        with open(path, newline='') as file:
+            rows = [row for row in csv.reader(file) if row]
+        if rows and not _is_number(rows[0][0]):
+            header = rows.pop(0)
+
+    # Rows written while the instrument was out have these channels empty.
+    # They are gaps to fill, not samples we already have.
+    filled_columns = [k for k, channel in enumerate(columns) if k > 0 and channel in values]
+    def is_gap(row):
+        return all(k >= len(row) or row[k] == '' for k in filled_columns)
+
+    existing = sorted(float(row[0]) for row in rows if not is_gap(row))
+    gaps = sorted((float(row[0]), row) for row in rows if is_gap(row))
+    gap_times = [gap[0] for gap in gaps]
+
+    added: List[List[str]] = []
+    filled = 0
+    for i, t in enumerate(times):
+        if math.isnan(t): continue
+
+        # Skip anything we already have (or just added) close to this time.
+        j = bisect.bisect_left(existing, t)
+        if (j < len(existing) and existing[j] - t <= tolerance) or (j > 0 and t - existing[j - 1] <= tolerance):
+            continue
+        bisect.insort(existing, t)
+
+        cells = []
+        for channel in columns[1:]:
+            value = values[channel][i] if channel in values else math.nan
+            cells.append('' if math.isnan(value) else repr(float(value)))
+
+        # Fill the empty row nearest this sample, if there is one close by.
+        j = bisect.bisect_left(gap_times, t)
+        nearest = min((k for k in (j - 1, j) if 0 <= k < len(gaps)), key=lambda k: abs(gap_times[k] - t), default=None)
+        if nearest is not None and abs(gap_times[nearest] - t) <= tolerance:
+            row = gaps[nearest][1]
+            row += [''] * (len(columns) - len(row))
+            for k in filled_columns:
+                row[k] = cells[k - 1]
+            del gaps[nearest], gap_times[nearest]
+            filled += 1
+        else:
+            added.append([repr(float(t))] + cells)
+
+    if not added and not filled: return 0
+
+    rows = sorted(rows + added, key=lambda row: float(row[0]))
+    temporary = path + '.tmp'
+    with open(temporary, 'w', newline='') as file:
+        writer = csv.writer(file)
+        if header is not None: writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(temporary, path)
+    return len(added) + filled
+
+
+def backfill_daily(directory: str, columns: Sequence[str], times, values: Dict[str, Sequence[float]], tolerance: float) -> int:
+    """
+    Merge samples into the daily YYYY-MM-DD.csv files in `directory`,
+    splitting them by local date the way run_monitors.py names its files.
+    On a day whose columns changed, they go into the file with `columns`.
+    Returns the number of rows added or filled.
+    """
+    by_file: Dict[str, List[int]] = {}
+    for i, t in enumerate(times):
+        if not math.isnan(t):
+            by_file.setdefault(_daily_path(directory, t, columns), []).append(i)
+
+    added = 0
+    for path, indices in by_file.items():
+        added += backfill_csv(
+            path, columns,
+            [times[i] for i in indices],
+            {channel: [series[i] for i in indices] for channel, series in values.items()},
+            tolerance,
+        )
+    return added
@@ -0,0 +1,159 @@
+"""
+Move storage off the acquisition loop.
+
+`BackgroundWriter` puts rows in a bounded queue, and a dedicated thread
+drains it into a writer such as `DailyCSVWriter`, a batch at a time. A
+slow disk or a stalled network share then holds up only that thread,
+not the next instrument read. If the queue fills up, `write` waits at
+most `block` seconds and then drops the row. Drops are counted and
+reported instead of slowing acquisition down.
+"""
+from typing import Callable, Optional, Sequence
+import queue, threading, time, traceback
+
+from colorama import Fore, Style
+
+
+class _Call:
+    """A function to run on the writer thread, in order with the rows."""
+
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+
+_STOP = object()
+
+
+class BackgroundWriter:
+
+    def __init__(self,
+            writer,
+            maxsize: int = 3600, # rows
+            batch_size: int = 256, # rows
+            block: float = 0.0, # seconds
+        ):
+        """
+        writer:
+            Anything with write(row) and close(), e.g. a DailyCSVWriter.
+            Only the writer thread touches it.
+
+        maxsize: int
+            Rows the queue holds before new ones are dropped. At 1 Hz the
+            default rides out an hour-long storage stall.
+
+        batch_size: int
+            Most rows written per pass before looking at the queue again.
+
+        block: float
+            How long `write` may wait for room in a full queue.
+        """
+        self.writer = writer
+        self.batch_size = batch_size
+        self.block = block
+
+        self._queue = queue.Queue(maxsize)
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._reported_drops = 0
+
+        self._thread = threading.Thread(target=self._run, name='background writer', daemon=True)
+        self._thread.start()
+
+
+    def write(self, row: Sequence) -> bool:
+        """Queue a row. Returns False if it was dropped because the queue is full."""
+        return self._put(row)
+
+
+    def call(self, function: Callable, *args) -> bool:
+        """
+        Run `function(*args)` on the writer thread, after the rows queued
+        before it. Use it for anything that touches the writer's files,
+        e.g. backfilling.
+        """
+        return self._put(_Call(function, args))
+
+
+    def _put(self, item) -> bool:
+        try:
+            if self.block > 0:
+                self._queue.put(item, timeout=self.block)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        depth = self._queue.qsize()
+        if depth > self.max_depth: self.max_depth = depth
+        return True
+
+
+    @property
+    def depth(self) -> int: return self._queue.qsize()
+
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'capacity': self._queue.maxsize,
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Write what's queued, then close the writer."""
+        if not self._thread.is_alive(): return
+        self._queue.put(_STOP) # Waits for room; closing must not drop rows
+        self._thread.join(timeout)
+
+
+    ##### Writer thread #####
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in batch:
+                if item is _STOP:
+                    self._close_writer()
+                    return
+                self._handle(item)
+
+            if self.dropped != self._reported_drops:
+                print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] Storage is falling behind: dropped {self.dropped - self._reported_drops} rows ({self.dropped} in total).')
+                self._reported_drops = self.dropped
+
+
+    def _handle(self, item) -> None:
+        try:
+            if isinstance(item, _Call):
+                item.function(*item.args)
+            else:
+                self.writer.write(item)
+                self.written += 1
+        except Exception:
+            # Keep going; the next row may well succeed (e.g. a share that came back).
+            self.errors += 1
+            print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {time.strftime("%H:%M:%S")}: Couldn\'t write to storage.')
+            print(traceback.format_exc())
+
+
+    def _close_writer(self) -> None:
+        try:
+            self.writer.close()
+        except Exception:
+            self.errors += 1
+            print(traceback.format_exc())
@@ -0,0 +1,121 @@
+"""
+A long-lived writer for the daily monitor CSV files.
+
+Instead of opening YYYY-MM-DD.csv, writing one row and closing it again
+for every sample, `DailyCSVWriter` keeps today's file open. Rows go into
+the file's buffer and reach the disk when a row or time budget runs out;
+an fsync every `fsync_interval` bounds how much a power cut can lose.
+The file is switched when a sample's time passes local midnight, and a
+new file starts with a header row. If the day's file already has other
+columns, the rows go into YYYY-MM-DD.1.csv (then .2, ...) instead.
+"""
+from typing import Optional, Sequence
+from datetime import datetime, timedelta
+import csv, os, time
+
+from colorama import Fore, Style
+
+from monitoring.backfill import _daily_path
+
+
+class DailyCSVWriter:
+
+    def __init__(self,
+            directory: str,
+            columns: Sequence[str],
+            flush_rows: int = 60,
+            flush_interval: float = 10.0, # seconds
+            fsync_interval: float = 60.0, # seconds
+        ):
+        """
+        directory: str
+            Where the YYYY-MM-DD.csv files go.
+
+        columns: list of str
+            'Time' (seconds since the epoch) first, then the channels.
+            Written as the header of new files.
+
+        flush_rows, flush_interval: int, float
+            Hand buffered rows to the OS after this many rows or seconds,
+            whichever comes first.
+
+        fsync_interval: float
+            Force flushed rows onto the disk at most this often. 0 syncs
+            at every flush; None leaves it to the OS.
+        """
+        self.directory = directory
+        self.columns = list(columns)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+
+        self.path: Optional[str] = None
+        self._file = None
+        self._writer = None
+        self._day_start = self._day_end = 0.0 # Local midnights around the open file's day
+        self._pending = 0
+        self._flushed_at = self._synced_at = time.monotonic()
+
+
+    def write(self, row: Sequence) -> None:
+        """
+        Append one sample, aligned with `columns`. None and NaN values are
+        left empty.
+        """
+        t = row[0]
+        if self._file is None or not self._day_start <= t < self._day_end:
+            self._open(t)
+
+        self._writer.writerow(['' if value is None or value != value else value for value in row]) # value != value: NaN
+        self._pending += 1
+
+        now = time.monotonic()
+        if self._pending >= self.flush_rows or now - self._flushed_at >= self.flush_interval:
+            self.flush(now)
+
+
+    def flush(self, now: Optional[float] = None) -> None:
+        if self._file is None: return
+        now = time.monotonic() if now is None else now
+
+        self._file.flush()
+        self._pending = 0
+        self._flushed_at = now
+        if self.fsync_interval is not None and now - self._synced_at >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._synced_at = now
+
+
+    def close(self) -> None:
+        """
+        Flush, sync and close the current file. The next `write` opens the
+        right file again, so this is also how to let something else (e.g.
+        monitoring.backfill) rewrite it.
+        """
+        if self._file is None: return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = self._writer = self.path = None
+
+
+    def _open(self, t: float) -> None:
+        self.close()
+
+        day = datetime.fromtimestamp(t).replace(hour=0, minute=0, second=0, microsecond=0)
+        self._day_start = day.timestamp()
+        self._day_end = (day + timedelta(days=1)).timestamp() # DST days aren't 24 h
+
+        self.path = _daily_path(self.directory, t, self.columns)
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        if new and os.path.basename(self.path).count('.') > 1:
+            print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}The columns changed today; writing to {self.path}.{Style.RESET_ALL}')
+        self._file = open(self.path, 'a', newline='', buffering=1 << 16)
+        self._writer = csv.writer(self._file)
+        if new: self._writer.writerow(self.columns)
+        self._synced_at = time.monotonic()
+
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc) -> None: self.close()
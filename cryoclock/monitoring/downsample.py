@@ -0,0 +1,132 @@
+"""
+Streaming downsampling of monitor rows into coarser tiers.
+
+For each window size (10 s, 5 min and 1 h by default) a `Downsampler`
+keeps the min, max, mean, last value and count of every channel over the
+current window. Each sample updates them in constant time. When a sample
+falls in a new window, the finished one is written to that tier's files
+as one row, so plotting a month needs at most a few thousand rows
+instead of millions, with the extremes kept.
+
+Windows are aligned to multiples of their size since the epoch, and a
+row's Time is the start of its window. None and NaN samples are left
+out; a channel with no samples in a window is left empty. On close the
+window in progress is written too, so after a restart the same window
+can appear twice with counts that add up.
+"""
+from typing import List, Sequence
+import math, os
+
+from monitoring.sinks import CSVSink
+
+STATISTICS = ('min', 'max', 'mean', 'last', 'count')
+
+
+class Tier:
+    """The running aggregates of one window size."""
+
+    def __init__(self, window: float, channels: int, sink):
+        self.window = window
+        self.sink = sink
+        self.start = None # Start of the current window
+        self._channels = channels
+        self._reset()
+
+
+    def _reset(self) -> None:
+        n = self._channels
+        self.min: List[float] = [math.inf] * n
+        self.max: List[float] = [-math.inf] * n
+        self.sum: List[float] = [0.0] * n
+        self.last: List[float] = [math.nan] * n
+        self.count: List[int] = [0] * n
+
+
+    def add(self, t: float, values: Sequence) -> None:
+        start = t - t % self.window
+        if start != self.start:
+            self.emit()
+            self.start = start
+
+        for i, value in enumerate(values):
+            if value is None or value != value: continue # value != value: NaN
+            if value < self.min[i]: self.min[i] = value
+            if value > self.max[i]: self.max[i] = value
+            self.sum[i] += value
+            self.last[i] = value
+            self.count[i] += 1
+
+
+    def row(self) -> list:
+        row = [self.start]
+        for i in range(self._channels):
+            count = self.count[i]
+            if count:
+                row += [self.min[i], self.max[i], self.sum[i] / count, self.last[i], count]
+            else:
+                row += [None, None, None, None, 0]
+        return row
+
+
+    def emit(self) -> None:
+        """Write the current window, if it has any samples, and start over."""
+        if self.start is not None and any(self.count):
+            self.sink.write(self.row())
+        self._reset()
+
+
+
+def label(window: float) -> str:
+    """'10s', '5min', '1h', ... for directory names."""
+    for unit, seconds in (('d', 86400), ('h', 3600), ('min', 60)):
+        if window >= seconds and window % seconds == 0:
+            return f'{window // seconds:g}{unit}'
+    return f'{window:g}s'
+
+
+def tier_columns(columns: Sequence[str]) -> List[str]:
+    return [columns[0]] + [f'{channel} {statistic}' for channel in columns[1:] for statistic in STATISTICS]
+
+
+
+class Downsampler:
+
+    def __init__(self,
+            columns: Sequence[str],
+            windows: Sequence[float] = (10, 300, 3600), # seconds
+            directory: str = 'tiers',
+            spill_directory: str = 'spill',
+        ):
+        """
+        columns: list of str
+            'Time' first, then the channels; the rows run_monitors writes.
+
+        windows: list of float
+            Window sizes in seconds. Each tier goes into its own daily
+            CSV files, e.g. tiers/5min/YYYY-MM-DD.csv, with columns
+            '<channel> min', '<channel> max', ... per channel.
+
+        directory, spill_directory: str
+            Where the tier directories go, and where rows wait if they
+            can't be written (see monitoring/sinks.py).
+        """
+        self.columns = tier_columns(columns)
+        self.tiers: List[Tier] = []
+        for window in windows:
+            path = os.path.join(directory, label(window))
+            os.makedirs(path, exist_ok=True)
+            # Tier rows are rare, so hand each one to the disk straight away.
+            sink = CSVSink(path, self.columns, name=f'tier-{label(window)}', batch_size=1, spill_directory=spill_directory)
+            self.tiers.append(Tier(window, len(columns) - 1, sink))
+
+
+    def write(self, row: Sequence) -> None:
+        t, values = row[0], row[1:]
+        for tier in self.tiers:
+            tier.add(t, values)
+
+
+    def close(self) -> None:
+        for tier in self.tiers:
+            tier.emit()
+            tier.sink.close()
@@ -0,0 +1,241 @@
+"""
+A small HTTP and WebSocket endpoint for live monitor data.
+
+`MonitorServer` runs an asyncio server on its own thread, so any number
+of viewers can watch the cryostat without opening their own connection
+to the instruments or reparsing the CSV files. History comes from the
+shared-memory ring (monitoring/shared_ring.py), new rows from `publish`.
+Only the standard library is used.
+
+    GET /latest                     {"Time": ..., "40K plat": ..., ...}
+    GET /columns                    ["Time", "40K plat", ...]
+    GET /range?last=3600            {"columns": [...], "rows": [[...], ...]}
+    GET /range?start=T0&end=T1      (seconds since the epoch)
+    GET /stream                     WebSocket; one JSON row object per sample
+
+Values that couldn't be read are null.
+"""
+from typing import Optional, Sequence, Set
+from urllib.parse import parse_qs, urlsplit
+import asyncio, base64, hashlib, json, math, struct, threading, time
+
+from colorama import Fore, Style
+
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+def _json_value(value):
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else value
+
+
+class MonitorServer:
+
+    def __init__(self,
+            ring,
+            host: str = '127.0.0.1',
+            port: int = 8080,
+            max_rows: int = 100000,
+            client_queue: int = 100, # rows
+        ):
+        """
+        ring: SharedRing
+            Where the recent rows are; its columns name the fields.
+
+        host, port: str, int
+            Where to listen. The default only answers on this machine;
+            use '0.0.0.0' to serve the lab network.
+
+        max_rows: int
+            Most rows one /range answer returns.
+
+        client_queue: int
+            Rows buffered per WebSocket viewer. A viewer that falls
+            further behind loses the oldest ones rather than slowing the
+            others down.
+        """
+        self.ring = ring
+        self.columns = list(ring.columns)
+        self.host = host
+        self.port = port
+        self.max_rows = max_rows
+        self.client_queue = client_queue
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: Set[asyncio.Queue] = set()
+        self._ready = threading.Event()
+
+
+    def start(self) -> 'MonitorServer':
+        """Serve from a background thread; returns once listening."""
+        threading.Thread(target=self._run, name='monitor http', daemon=True).start()
+        self._ready.wait()
+        if self._server is None:
+            raise OSError(f'Could not listen on {self.host}:{self.port}.')
+        return self
+
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1] # In case it was 0
+            print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Serving live data on {Style.RESET_ALL}{Style.BRIGHT}http://{self.host}:{self.port}/{Style.RESET_ALL}')
+        except OSError:
+            self._ready.set()
+            raise
+        self._ready.set()
+        self._loop.run_forever()
+
+
+    def close(self) -> None:
+        if self._loop is None: return
+        def stop():
+            self._server.close()
+            self._loop.stop()
+        self._loop.call_soon_threadsafe(stop)
+
+
+    def publish(self, row: Sequence) -> None:
+        """Push a new row to the WebSocket viewers. Safe to call from any thread."""
+        if self._loop is None or not self._clients: return
+        message = json.dumps({column: _json_value(value) for column, value in zip(self.columns, row)})
+        self._loop.call_soon_threadsafe(self._broadcast, _frame(0x1, message.encode()))
+
+
+    def _broadcast(self, frame: bytes) -> None:
+        for queue in self._clients:
+            if queue.full(): queue.get_nowait() # Drop this viewer's oldest row
+            queue.put_nowait(frame)
+
+
+    ##### HTTP #####
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')
+            method, target, _ = request_line.split(' ', 2)
+            headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(':')
+                if name: headers[name.strip().lower()] = value.strip()
+
+            url = urlsplit(target)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+            if method != 'GET':
+                await self._respond(writer, 405, {'error': 'Only GET is supported.'})
+            elif url.path == '/stream' and headers.get('upgrade', '').lower() == 'websocket':
+                await self._stream(reader, writer, headers)
+            elif url.path == '/latest':
+                latest = self.ring.latest()
+                await self._respond(writer, 200, latest and {column: _json_value(value) for column, value in latest.items()})
+            elif url.path == '/columns':
+                await self._respond(writer, 200, self.columns)
+            elif url.path == '/range':
+                await self._respond(writer, 200, self._range(query))
+            else:
+                await self._respond(writer, 404, {'error': f'No such path {url.path}.', 'paths': ['/latest', '/columns', '/range', '/stream']})
+        except ValueError as error:
+            await self._respond(writer, 400, {'error': str(error)})
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    def _range(self, query: dict) -> dict:
+        if 'last' in query:
+            start, end = time.time() - float(query['last']), math.inf
+        else:
+            start = float(query.get('start', '-inf'))
+            end = float(query.get('end', 'inf'))
+
+        rows = self.ring.since(start)
+        rows = rows[rows[:, 0] <= end][-self.max_rows:]
+        return {
+            'columns': self.columns,
+            'rows': [[_json_value(value) for value in row] for row in rows.tolist()],
+        }
+
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, body) -> None:
+        data = json.dumps(body).encode()
+        writer.write(
+            f'HTTP/1.1 {status} {_REASONS[status]}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(data)}\r\n'
+            f'Access-Control-Allow-Origin: *\r\n'
+            f'Connection: close\r\n\r\n'.encode() + data
+        )
+        await writer.drain()
+
+
+    ##### WebSocket #####
+    async def _stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: dict) -> None:
+        key = headers.get('sec-websocket-key')
+        if not key: raise ValueError('Missing Sec-WebSocket-Key.')
+        accept = base64.b64encode(hashlib.sha1((key + _WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write(
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Accept: {accept}\r\n\r\n'.encode()
+        )
+        await writer.drain()
+
+        queue = asyncio.Queue(self.client_queue)
+        self._clients.add(queue)
+        receiving = asyncio.ensure_future(self._receive(reader, writer))
+        try:
+            while not receiving.done():
+                sending = asyncio.ensure_future(queue.get())
+                await asyncio.wait({sending, receiving}, return_when=asyncio.FIRST_COMPLETED)
+                if not sending.done():
+                    sending.cancel()
+                    break
+                writer.write(sending.result())
+                await writer.drain()
+        finally:
+            self._clients.discard(queue)
+            receiving.cancel()
+
+
+    async def _receive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answer pings and return when the viewer closes the connection."""
+        try:
+            await self._receive_frames(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # Gone without a close frame
+
+
+    async def _receive_frames(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while True:
+            first, second = await reader.readexactly(2)
+            opcode, length = first & 0x0F, second & 0x7F
+            if length == 126:
+                length, = struct.unpack('>H', await reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('>Q', await reader.readexactly(8))
+            mask = await reader.readexactly(4) if second & 0x80 else b'\0\0\0\0'
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(await reader.readexactly(length)))
+
+            if opcode == 0x8: # Close
+                writer.write(_frame(0x8, payload[:2]))
+                return
+            if opcode == 0x9: # Ping
+                writer.write(_frame(0xA, payload))
+
+
+
+def _frame(opcode: int, payload: bytes) -> bytes:
+    """An unmasked, unfragmented frame, as a server sends them."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+    return header + payload
@@ -0,0 +1,162 @@
+"""
+Poll slow or unreliable instruments without holding up the others.
+
+Every `period` seconds a `PolledDevice`'s `poll` starts the next read on
+a worker thread and returns straight away, one read at a time, so the
+drivers' blocking serial calls never run on the acquisition thread. A
+gauge that hangs holds up only its own worker; its values go stale
+(None) until it answers again. The acquisition loop takes `latest()`
+from each device when it builds a row, so everything ends up in one
+time-aligned stream.
+
+How to use with the scheduler::
+
+    >>> gauge = hornet('COM7')
+    >>> scheduler.every(gauge.period, gauge.poll, name=gauge.name)
+    >>> ...
+    >>> row += gauge.latest()
+"""
+from typing import Callable, List, Optional, Sequence
+import importlib.util, os, threading, time, traceback
+
+from colorama import Fore, Style
+
+
+class PolledDevice:
+
+    def __init__(self,
+            name: str,
+            connect: Callable[[], object],
+            read: Callable[[object], Sequence[float]],
+            fields: Sequence[str],
+            period: float, # seconds
+            timeout: float = 5.0, # seconds
+        ):
+        """
+        name: str
+            Used in messages, and as the prefix of the column names.
+
+        connect: callable
+            Opens the device and returns the driver object. Called on the
+            worker thread, and again after a read fails.
+
+        read: callable
+            read(driver) returns the values of `fields`, in order.
+
+        fields: list of str
+            What `read` returns, e.g. ['pressure (torr)'].
+
+        period: float
+            Seconds between reads.
+
+        timeout: float
+            A read that takes longer than this is reported as hung, and
+            values older than period + timeout are stale.
+        """
+        self.name = name
+        self._connect = connect
+        self._read = read
+        self.fields = list(fields)
+        self.period = period
+        self.timeout = timeout
+
+        self.driver = None
+        self.reads = 0
+        self.errors = 0
+        self.busy = 0 # Polls skipped because the last read hadn't finished
+        self._values: Optional[tuple] = None # (time.monotonic(), values) of the last good read
+        self._started: Optional[float] = None # When the running read began
+        self._warned = False
+
+
+    @property
+    def columns(self) -> List[str]:
+        return [f'{self.name} {field}' for field in self.fields]
+
+
+    def poll(self) -> None:
+        """Start a read on the worker, unless the last one is still running."""
+        started = self._started
+        if started is not None:
+            self.busy += 1
+            if not self._warned and time.monotonic() - started > self.timeout:
+                self._warned = True
+                print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {self.name} hasn\'t answered for {time.monotonic() - started:.0f} s.')
+            return
+
+        self._started = time.monotonic()
+        # A daemon thread, so a read that never returns can't keep the process alive.
+        threading.Thread(target=self._run, name=f'poll {self.name}', daemon=True).start()
+
+
+    def latest(self) -> list:
+        """The last values read, or Nones if they are stale."""
+        values = self._values
+        if values is None or time.monotonic() - values[0] > self.period + self.timeout:
+            return [None] * len(self.fields)
+        return list(values[1])
+
+
+    def close(self) -> None:
+        if self._started is None: self._disconnect()
+
+
+    def _run(self) -> None:
+        try:
+            if self.driver is None:
+                self.driver = self._connect()
+            values = tuple(self._read(self.driver))
+            self._values = (time.monotonic(), values)
+            self.reads += 1
+            if self._warned:
+                print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}{self.name} is answering again.{Style.RESET_ALL}')
+                self._warned = False
+        except Exception:
+            self.errors += 1
+            print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {time.strftime("%H:%M:%S")}: {self.name} error.')
+            print(traceback.format_exc())
+            self._disconnect()
+        finally:
+            self._started = None
+
+
+    def _disconnect(self) -> None:
+        """Drop the driver so the next poll reconnects."""
+        driver, self.driver = self.driver, None
+        try:
+            if driver is not None: driver.close_connection()
+        except Exception:
+            pass
+
+
+    def stats(self) -> dict:
+        return {'reads': self.reads, 'errors': self.errors, 'busy': self.busy}
+
+
+
+##### Drivers in devices/ #####
+DEVICES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'devices')
+
+def _load_driver(filename: str, name: str):
+    """Import a class from devices/, whose file names aren't always valid module names."""
+    path = os.path.join(DEVICES_DIRECTORY, filename)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(filename)[0].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, name)
+
+
+def hornet(port: str, rs485_addr: str = '01', period: float = 10.0, timeout: float = 5.0) -> PolledDevice:
+    """The Hornet IGM401 ion gauge on a serial (RS-485) port."""
+    def connect():
+        return _load_driver('hornet_IGM401.py', 'Hornet_IGM401')(serial_addr=port, rs485_addr=rs485_addr)
+    return PolledDevice('Hornet', connect, lambda gauge: [gauge.get_ig_pressure()], ['pressure (torr)'], period, timeout)
+
+
+def nextorr(port: str, period: float = 60.0, timeout: float = 5.0) -> PolledDevice:
+    """The NEXTorr D100-5 ion pump's NIOPS-03 controller on a serial port."""
+    def connect():
+        return _load_driver('nextorr_D100-5_pump.py', 'Nextorr_D100_5_pump')(address=port)
+    def read(pump):
+        return [pump.get_ionpump_voltage(), pump.get_ionpump_current()]
+    return PolledDevice('NEXTorr', connect, read, ['voltage (kV)', 'current (nA)'], period, timeout)
@@ -0,0 +1,134 @@
+"""
+Run periodic tasks on absolute deadlines.
+
+Sleeping a fixed time after doing the work makes the real period the
+sleep plus the work, and the error adds up. `Scheduler` instead keeps
+each task's deadlines on a fixed grid of the monotonic clock: start +
+k * period. Time spent in a task doesn't push later samples back. A
+task that overruns skips the deadlines it missed rather than running
+several times in a row to catch up.
+
+How to use::
+
+    >>> scheduler = Scheduler()
+    >>> temperatures = scheduler.every(1.0, read_temperatures, name='CTC100')
+    >>> scheduler.every(10.0, read_pressure, name='Hornet')
+    >>> scheduler.run()
+
+Tasks run one at a time, in the thread that calls `run`. Tasks that come
+due together run in the order they were added. A task can check its
+`tick`, the index of the deadline it is running for, to do something
+only every nth time. Ticks count skipped deadlines too, so that cadence
+doesn't drift either.
+"""
+from typing import Callable, List, Optional
+import heapq, itertools, math, threading, time, traceback
+
+from colorama import Fore, Style
+
+from headers.telemetry import LatencyHistogram
+
+
+class Task:
+    """One periodic task and its timing statistics."""
+
+    def __init__(self, name: str, period: float, function: Callable[[], None], start: float):
+        self.name = name
+        self.period = period
+        self.function = function
+        self.start = start
+        self.tick = 0
+        self.deadline = start
+
+        self.runs = 0
+        self.skipped = 0 # Deadlines missed because an earlier run overran
+        self.errors = 0
+        self.lateness = LatencyHistogram() # Deadline to the start of the run
+        self.duration = LatencyHistogram()
+
+
+    def snapshot(self) -> dict:
+        return {
+            'period': self.period,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'lateness': self.lateness.snapshot(),
+            'duration': self.duration.snapshot(),
+        }
+
+
+
+class Scheduler:
+
+    def __init__(self):
+        self.tasks: List[Task] = []
+        self._queue = [] # (deadline, order, task)
+        self._order = itertools.count()
+        self._origin = time.monotonic()
+        self._stopped = threading.Event()
+
+
+    def every(self, period: float, function: Callable[[], None], name: Optional[str] = None, offset: float = 0.0) -> Task:
+        """
+        Run `function()` every `period` seconds. Tasks share one time
+        origin, so periods that are multiples of each other stay in step;
+        `offset` shifts this task's deadlines, e.g. to spread slow reads.
+        """
+        task = Task(name or getattr(function, '__name__', 'task'), period, function, self._origin + offset)
+        self.tasks.append(task)
+        heapq.heappush(self._queue, (task.deadline, next(self._order), task))
+        return task
+
+
+    def run(self) -> None:
+        """Run tasks until `stop` is called."""
+        while self._queue and not self._stopped.is_set():
+            deadline, order, task = self._queue[0]
+            delay = deadline - time.monotonic()
+            if delay > 0 and self._stopped.wait(delay):
+                return
+
+            heapq.heappop(self._queue)
+            self._run(task)
+            heapq.heappush(self._queue, (task.deadline, order, task))
+
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+    def _run(self, task: Task) -> None:
+        started = time.monotonic()
+        task.lateness.observe(max(0.0, started - task.deadline))
+        try:
+            task.function()
+        except Exception:
+            task.errors += 1
+            print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {time.strftime("%H:%M:%S")}: {task.name} failed.')
+            print(traceback.format_exc())
+        finished = time.monotonic()
+        task.duration.observe(finished - started)
+        task.runs += 1
+
+        # Next deadline on the grid that's still ahead.
+        ticks = max(1, math.floor((finished - task.start) / task.period) + 1 - task.tick)
+        task.skipped += ticks - 1
+        task.tick += ticks
+        task.deadline = task.start + task.tick * task.period
+
+
+    def stats(self) -> dict:
+        return {task.name: task.snapshot() for task in self.tasks}
+
+
+    def report(self) -> str:
+        """One line per task: runs, skips and lateness."""
+        lines = []
+        for task in self.tasks:
+            lateness = task.lateness
+            lines.append(
+                f'{task.name}: {task.runs} runs, {task.skipped} skipped, {task.errors} errors, '
+                f'late by {1e3 * lateness.quantile(0.5):.3g} ms (p50) / {1e3 * lateness.quantile(0.99):.3g} ms (p99) / {1e3 * lateness.max:.3g} ms (max)'
+            )
+        return '\n'.join(lines)
@@ -0,0 +1,169 @@
+"""
+Recent monitor samples in shared memory, for other processes.
+
+The acquisition process publishes each row into a fixed-size ring of
+float64 rows in a `multiprocessing.shared_memory` block. Plotters, alarm
+checkers or dashboards attach to it by name and read the last N samples
+at any rate, without touching the disk or the instrument::
+
+    >>> ring = SharedRing.attach('cryoclock')
+    >>> ring.columns
+    ['Time', '40K plat', '4K cyl', '40K shield', 'ivc']
+    >>> data = ring.read(3600) # The last hour at 1 Hz, oldest first
+
+Layout: a 64-byte header, the JSON metadata (the column names), then
+`capacity` rows of len(columns) float64s. The header holds the magic
+b'CRYORING', the capacity, the number of columns, the metadata length,
+and two sample counters, `begun` and `committed`.
+
+There is one writer and no lock. The writer bumps `begun`, writes sample
+n into row n % capacity, then sets `committed`. A reader reads
+`committed`, copies the rows it wants, and then reads `begun`. Any copied
+sample older than begun - capacity may have been overwritten while it
+was being copied, so it is dropped. Readers never block the writer, and
+never return a torn row.
+"""
+from typing import List, Optional, Sequence
+from multiprocessing import shared_memory
+import json, struct
+
+MAGIC = b'CRYORING'
+_HEADER = struct.Struct('<8sQQQ') # magic, capacity, width, metadata length
+_HEADER_SIZE = 64 # The counters follow at bytes 32 and 40
+_BEGUN, _COMMITTED = 4, 5 # ...as uint64 indices into the header
+
+
+class SharedRing:
+
+    def __init__(self, memory: shared_memory.SharedMemory, owner: bool):
+        """Use `create` or `attach`."""
+        import numpy as np
+
+        self.memory = memory
+        self.owner = owner
+        magic, self.capacity, self.width, length = _HEADER.unpack_from(memory.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'Shared memory {memory.name!r} is not a monitor ring.')
+
+        self.columns: List[str] = json.loads(bytes(memory.buf[_HEADER_SIZE:_HEADER_SIZE + length]))['columns']
+        offset = _data_offset(length)
+        self._counters = np.ndarray((_HEADER_SIZE // 8,), dtype=np.uint64, buffer=memory.buf)
+        self.array = np.ndarray((self.capacity, self.width), dtype=np.float64, buffer=memory.buf, offset=offset)
+        """The ring itself, zero-copy. Rows change under you; `read` checks for that."""
+
+
+    @classmethod
+    def create(cls, name: str, columns: Sequence[str], capacity: int = 86400) -> 'SharedRing':
+        """
+        Make a new ring for rows of `columns` ('Time' first), holding the
+        last `capacity` rows (a day at 1 Hz by default). A stale ring of
+        the same name, left by a process that crashed, is replaced.
+        """
+        import numpy as np
+
+        metadata = json.dumps({'columns': list(columns)}).encode()
+        size = _data_offset(len(metadata)) + capacity * len(columns) * 8
+        try:
+            memory = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            memory = shared_memory.SharedMemory(name, create=True, size=size)
+
+        _HEADER.pack_into(memory.buf, 0, MAGIC, capacity, len(columns), len(metadata))
+        memory.buf[_HEADER_SIZE:_HEADER_SIZE + len(metadata)] = metadata
+        ring = cls(memory, owner=True)
+        ring._counters[_BEGUN] = ring._counters[_COMMITTED] = 0
+        ring.array[:] = np.nan
+        return ring
+
+
+    @classmethod
+    def attach(cls, name: str) -> 'SharedRing':
+        """Open a ring that another process created, for reading."""
+        return cls(_attach(name), owner=False)
+
+
+    ##### Writing #####
+    def write(self, row: Sequence) -> None:
+        """Publish one row, aligned with `columns`. None is stored as NaN."""
+        n = int(self._counters[_COMMITTED])
+        self._counters[_BEGUN] = n + 1
+        self.array[n % self.capacity] = row
+        self._counters[_COMMITTED] = n + 1
+
+
+    ##### Reading #####
+    @property
+    def count(self) -> int:
+        """Rows published so far, including ones the ring no longer holds."""
+        return int(self._counters[_COMMITTED])
+
+
+    def read(self, n: Optional[int] = None):
+        """
+        A copy of the last `n` rows (default: all the ring holds), oldest
+        first, as a (rows, len(columns)) array. Can come back with fewer
+        rows if the writer overtook the copy.
+        """
+        import numpy as np
+
+        end = int(self._counters[_COMMITTED])
+        start = max(0, end - self.capacity, end - (self.capacity if n is None else n))
+        first, last = start % self.capacity, end % self.capacity
+        if end - start == 0:
+            rows = np.empty((0, self.width))
+        elif first < last:
+            rows = self.array[first:last].copy()
+        else:
+            rows = np.concatenate((self.array[first:], self.array[:last]))
+
+        # Drop whatever the writer may have overwritten while we copied.
+        overwritten = int(self._counters[_BEGUN]) - self.capacity - start
+        return rows[overwritten:] if overwritten > 0 else rows
+
+
+    def latest(self) -> Optional[dict]:
+        """The newest row as {column: value}, or None if there isn't one yet."""
+        rows = self.read(1)
+        return dict(zip(self.columns, rows[0].tolist())) if len(rows) else None
+
+
+    def since(self, t: float):
+        """A copy of the rows with Time after `t`, oldest first."""
+        import numpy as np
+        rows = self.read()
+        return rows[np.searchsorted(rows[:, 0], t, side='right'):]
+
+
+    def close(self) -> None:
+        """Detach; the writer also removes the ring."""
+        self.array = self._counters = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc) -> None: self.close()
+
+
+
+def _data_offset(metadata_length: int) -> int:
+    return -(-(_HEADER_SIZE + metadata_length) // 64) * 64
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach without letting this process's resource tracker remove the
+    block when it exits; that's the writer's job.
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False) # Python 3.13+
+    except TypeError:
+        from multiprocessing import resource_tracker
+        memory = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
@@ -0,0 +1,320 @@
+"""
+Pluggable, batched destinations for monitor rows.
+
+A sink collects rows and sends them as one batch when `batch_size` rows
+are waiting or `flush_interval` seconds have passed. If sending fails
+(the disk or share is gone, the database is down), the batch is spilled
+to a file in `spill_directory` instead. Spilled batches are replayed, oldest
+first, before the next batch that goes through, so nothing is lost or
+reordered. After a failure the sink waits with exponential backoff
+before trying the destination again, and spills in the meantime.
+
+Sinks have the write(row)/close() interface of the other writers, so
+put them behind a BackgroundWriter, together through `FanOut`. Then
+network trouble never slows acquisition.
+
+    CSVSink      the daily YYYY-MM-DD.csv files (monitoring/csv_writer.py)
+    ArchiveSink  binary segments (monitoring/archive.py)
+    InfluxSink   InfluxDB 2 line protocol over HTTP, standard library only
+"""
+from typing import List, Optional, Sequence
+import itertools, json, math, os, re, time, traceback
+import urllib.error, urllib.parse, urllib.request
+
+from colorama import Fore, Style
+
+from monitoring.archive import ArchiveWriter
+from monitoring.csv_writer import DailyCSVWriter
+
+
+class SinkRejected(Exception):
+    """The destination refused the data itself; retrying won't help."""
+
+
+
+class PartialDelivery(Exception):
+    """`send` got the first `delivered` rows through before failing with `error`."""
+
+    def __init__(self, delivered: int, error: Exception):
+        super().__init__(f'{delivered} rows delivered before {error!r}')
+        self.delivered = delivered
+        self.error = error
+
+
+
+class Sink:
+
+    def __init__(self,
+            name: str,
+            batch_size: int = 60, # rows
+            flush_interval: float = 10.0, # seconds
+            spill_directory: str = 'spill',
+            backoff: float = 1.0, # seconds
+            max_backoff: float = 300.0, # seconds
+        ):
+        """
+        name: str
+            Used in messages and in the spill file names.
+
+        batch_size, flush_interval: int, float
+            Send after this many rows or seconds, whichever comes first.
+
+        spill_directory: str
+            Where batches that couldn't be sent wait to be replayed.
+
+        backoff, max_backoff: float
+            First and longest wait before trying a failed destination again.
+        """
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_directory = spill_directory
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.sent = 0
+        self.spilled = 0
+        self.rejected = 0
+        self._batch: List[Sequence] = []
+        self._flushed_at = time.monotonic()
+        self._retry_at = 0.0
+        self._delay = backoff
+        self._sequence = itertools.count()
+
+
+    def send(self, rows: List[Sequence]) -> None:
+        """
+        Deliver a batch. Raise SinkRejected for bad data, PartialDelivery
+        if only some rows got through, anything else to retry later.
+        """
+        raise NotImplementedError
+
+
+    def write(self, row: Sequence) -> None:
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size or time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+
+    def flush(self) -> None:
+        batch, self._batch = self._batch, []
+        now = self._flushed_at = time.monotonic()
+        if now < self._retry_at:
+            self._spill(batch)
+            return
+
+        try:
+            self._replay()
+            if batch:
+                self._deliver(batch)
+        except Exception as error:
+            self._spill(batch)
+            self._retry_at = now + self._delay
+            print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {time.strftime("%H:%M:%S")}: {self.name} failed ({error!r}); spilling to {self.spill_directory} and retrying in {self._delay:g} s.')
+            self._delay = min(2 * self._delay, self.max_backoff)
+            return
+
+        if self._delay != self.backoff:
+            print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}{self.name} is back.{Style.RESET_ALL}')
+            self._delay = self.backoff
+
+
+    def close(self) -> None:
+        self.flush()
+
+
+    def stats(self) -> dict:
+        return {'sent': self.sent, 'spilled': self.spilled, 'rejected': self.rejected, 'pending': len(self.spill_files())}
+
+
+    def _deliver(self, rows: List[Sequence]) -> None:
+        """Send `rows`. If that fails part way, the rows that got through are removed from the list."""
+        try:
+            self.send(rows)
+        except PartialDelivery as partial:
+            self.sent += partial.delivered
+            del rows[:partial.delivered] # Only the rest is spilled or kept for replay
+            raise partial.error from None
+        except SinkRejected as error:
+            self.rejected += len(rows)
+            print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {self.name} rejected {len(rows)} rows ({error}); dropping them.')
+            return
+        self.sent += len(rows)
+
+
+    ##### Spill files #####
+    def spill_files(self) -> List[str]:
+        # Exactly <name>-<time>-<sequence>.jsonl, so 'csv' doesn't take the files of 'csv-permanent'.
+        pattern = re.compile(re.escape(self.name) + r'-\d{20}-\d{6}\.jsonl')
+        try:
+            names = os.listdir(self.spill_directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.spill_directory, name) for name in sorted(names) if pattern.fullmatch(name)] # Names sort by time of spilling
+
+
+    def _spill(self, rows: List[Sequence]) -> None:
+        if not rows: return
+        os.makedirs(self.spill_directory, exist_ok=True)
+        path = os.path.join(self.spill_directory, f'{self.name}-{time.time_ns():020d}-{next(self._sequence):06d}.jsonl')
+        _write_rows(path, rows)
+        self.spilled += len(rows)
+
+
+    def _replay(self) -> None:
+        """Send spilled batches, oldest first; stops at the first failure by raising."""
+        for path in self.spill_files():
+            with open(path) as file:
+                rows = [json.loads(line) for line in file if line.strip()]
+            count = len(rows)
+            try:
+                self._deliver(rows)
+            except Exception:
+                if rows and len(rows) < count:
+                    _write_rows(path, rows) # Keep only what didn't get through
+                elif not rows:
+                    os.remove(path)
+                raise
+            os.remove(path)
+
+
+
+def _write_rows(path: str, rows: List[Sequence]) -> None:
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as file:
+        for row in rows:
+            file.write(json.dumps(list(row)) + '\n') # NaN is written as NaN, which json reads back
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path) # A replay never sees half a batch
+
+
+
+class _WriterSink(Sink):
+    """A sink in front of a DailyCSVWriter or ArchiveWriter."""
+
+    def send(self, rows):
+        written = 0
+        try:
+            for row in rows:
+                self.writer.write(row)
+                written += 1 # The writer hands each row to the OS (flush_rows=1)
+            self.writer.flush()
+        except Exception as error:
+            # Start from a fresh file handle when the storage comes back.
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+            if written: raise PartialDelivery(written, error) from error
+            raise
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+
+class CSVSink(_WriterSink):
+    """The daily YYYY-MM-DD.csv files."""
+
+    def __init__(self, directory: str, columns: Sequence[str], **kwargs):
+        kwargs.setdefault('name', 'csv')
+        super().__init__(**kwargs)
+        # The sink does the batching, so the writer hands every batch to the OS.
+        self.writer = DailyCSVWriter(directory, columns, flush_rows=1)
+
+
+
+class ArchiveSink(_WriterSink):
+    """Binary archive segments."""
+
+    def __init__(self, directory: str, columns: Sequence[str], dtype: str = '<f4', **kwargs):
+        kwargs.setdefault('name', 'archive')
+        super().__init__(**kwargs)
+        self.writer = ArchiveWriter(directory, columns, dtype, flush_rows=1)
+
+
+
+class InfluxSink(Sink):
+    """
+    InfluxDB 2 through its HTTP write API, one line-protocol request per
+    batch. Each row becomes one point of `measurement`, with a field per
+    channel; None and NaN values are left out.
+    """
+
+    def __init__(self,
+            url: str,
+            bucket: str,
+            columns: Sequence[str],
+            measurement: str = 'temperatures',
+            org: str = 'onix',
+            token: Optional[str] = None,
+            timeout: float = 5.0, # seconds
+            **kwargs,
+        ):
+        kwargs.setdefault('name', f'influx-{bucket}')
+        super().__init__(**kwargs)
+        query = urllib.parse.urlencode({'org': org, 'bucket': bucket, 'precision': 'ms'})
+        self.endpoint = f'{url.rstrip("/")}/api/v2/write?{query}'
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if token: self.headers['Authorization'] = f'Token {token}'
+        self.timeout = timeout
+
+        self._prefix = _escape(measurement, ', ')
+        self._keys = [_escape(column, ',= ') for column in columns[1:]]
+
+
+    def lines(self, rows: List[Sequence]) -> str:
+        lines = []
+        for row in rows:
+            fields = ','.join(
+                f'{key}={float(value)!r}' for key, value in zip(self._keys, row[1:])
+                if value is not None and not math.isnan(value)
+            )
+            if fields: lines.append(f'{self._prefix} {fields} {round(row[0] * 1000)}')
+        return '\n'.join(lines)
+
+
+    def send(self, rows):
+        body = self.lines(rows)
+        if not body: return
+        request = urllib.request.Request(self.endpoint, data=body.encode(), headers=self.headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as error:
+            # 4xx means the data or the credentials are wrong, except for rate limiting.
+            if 400 <= error.code < 500 and error.code != 429:
+                raise SinkRejected(f'HTTP {error.code}: {error.read()[:200]!r}') from error
+            raise
+
+
+
+def _escape(text: str, characters: str) -> str:
+    for character in characters:
+        text = text.replace(character, '\\' + character)
+    return text
+
+
+
+class FanOut:
+    """Write each row to several sinks; one failing doesn't stop the others."""
+
+    def __init__(self, sinks: Sequence):
+        self.sinks = list(sinks)
+
+    def write(self, row: Sequence) -> None:
+        for sink in self.sinks:
+            try:
+                sink.write(row)
+            except Exception:
+                print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] {time.strftime("%H:%M:%S")}: {getattr(sink, "name", sink)} failed.')
+                print(traceback.format_exc())
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                print(traceback.format_exc())
@@ -3,11 +3,13 @@
 ###
 
 import os
+import math
+import atexit
 import time
+import threading
 import traceback
 import asyncio
 from datetime import datetime
-import csv
 
 # #
 # # import influxdb_client
@@ -17,6 +19,16 @@ import csv
 #from onix.headers.pulse_tube import PulseTube
 #from onix.headers.wavemeter.wavemeter import WM
 from headers.ctc100 import CTC100
+from headers.circuit_breaker import DeviceUnavailable
+from headers.telemetry import write_prometheus
+from monitoring.backfill import backfill_daily
+from monitoring.background import BackgroundWriter
+from monitoring.sinks import ArchiveSink, CSVSink, FanOut, InfluxSink
+from monitoring.downsample import Downsampler
+from monitoring.shared_ring import SharedRing
+from monitoring.http_server import MonitorServer
+from monitoring.scheduler import Scheduler
+from monitoring.poller import hornet, nextorr
 #from onix.headers.ruuvi_gateway import RuuviGateway
 #from onix.headers.frg730 import FRG730
 
@@ -29,15 +41,27 @@ from headers.ctc100 import CTC100
 # # write_client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
 # # write_api = write_client.write_api(write_options=SYNCHRONOUS)
 
+# Point these at headers/ctc100_simulator.py to run without hardware.
+ctc_address = os.environ.get("CTC100_ADDRESS", "192.168.0.105")
+ctc_port = int(os.environ.get("CTC100_PORT", 23))
+
 #pt = PulseTube()
 #wm = WM()
-c = CTC100("192.168.0.105")
+c = CTC100(ctc_address, tcp_port=ctc_port)
 channels = c.channels
 print(channels)
 
 channels = ['40K plat', '4K cyl', '40K shield', 'ivc']
 
-columns = ['Time','40K plat', '4K cyl', '40K shield', 'ivc']
+# Gauges on serial ports, e.g. "COM7" and "COM5". Each is read on its own
+# thread at its own cadence, so a slow or hung gauge never delays the temperatures.
+hornet_port = os.environ.get("HORNET_PORT")
+nextorr_port = os.environ.get("NEXTORR_PORT")
+gauges = []
+if hornet_port: gauges.append(hornet(hornet_port))
+if nextorr_port: gauges.append(nextorr(nextorr_port))
+
+columns = ['Time','40K plat', '4K cyl', '40K shield', 'ivc'] + [column for gauge in gauges for column in gauge.columns]
 
 # # ruuvi_g = RuuviGateway(ip='192.168.0.225', username='ruuvi1', password='password123')
 # # ruuvi_dont_save = ['mac', 'tx_power', 'data_format']
@@ -46,18 +70,85 @@ columns = ['Time','40K plat', '4K cyl', '40K shield', 'ivc']
 
 high_freq_time = 1
 low_freq_time = 280
+permanent_every = max(1, round(low_freq_time / high_freq_time)) # Every nth sample also goes to the permanent store
 send_permanent = True
+prometheus_file = None # e.g. "cryoclock.prom" for node_exporter's textfile collector
+archive_directory = None # e.g. "archive" to also keep binary segments (monitoring/archive.py)
+tier_windows = (10, 300, 3600) # min/max/mean/last/count per channel over these windows, in ./tiers
+max_backfill = 3600 # Most points to recover from the CTC100's log after an outage
+log_chunk = 200 # Log queries pipelined at a time while recovering, between samples
+outage_start = None
+influx_url = os.environ.get("INFLUXDB_URL") # e.g. "http://onix-pc:8086"
+
+# Each sink sends a batch every 60 rows or 10 s, and spills to ./spill while
+# its destination is unreachable.
+csv_sink = CSVSink(".", columns)
+sinks = [csv_sink]
+if archive_directory is not None:
+    sinks.append(ArchiveSink(archive_directory, columns))
+if tier_windows:
+    sinks.append(Downsampler(columns, tier_windows, "tiers"))
+if influx_url is not None:
+    sinks.append(InfluxSink(influx_url, "live", columns, token=os.environ.get("INFLUXDB_TOKEN")))
+storage = BackgroundWriter(FanOut(sinks)) # Disk and network stalls hold up this thread, not the readings
+atexit.register(storage.close) # Don't lose queued rows on Ctrl+C
+
+# Every permanent_every-th row is also kept for good, in ./permanent/YYYY-MM-DD.csv
+# and the "permanent" InfluxDB bucket.
+os.makedirs("permanent", exist_ok=True)
+permanent_sinks = [CSVSink("permanent", columns, name="csv-permanent")]
+if influx_url is not None:
+    permanent_sinks.append(InfluxSink(influx_url, "permanent", columns, token=os.environ.get("INFLUXDB_TOKEN")))
+permanent = BackgroundWriter(FanOut(permanent_sinks))
+atexit.register(permanent.close)
+
+# The last day of rows in shared memory, for plotters and alarms in other
+# processes: SharedRing.attach("cryoclock").read(3600)
+ring = SharedRing.create("cryoclock", columns, capacity=86400)
+atexit.register(ring.close)
+
+# Optionally serve /latest, /range and a /stream WebSocket from that ring,
+# e.g. MONITOR_HTTP_PORT=8080 (monitoring/http_server.py).
+http_port = os.environ.get("MONITOR_HTTP_PORT")
+server = MonitorServer(ring, port=int(http_port)).start() if http_port else None
+
+
+def backfill(times, values, tolerance):
+    """Runs on the storage thread, in order with the rows."""
+    csv_sink.flush()
+    csv_sink.writer.close() # Backfilling rewrites the file; the writer reopens it
+    added = backfill_daily(".", columns, times, values, tolerance=tolerance)
+    print(datetime.now().strftime("%H:%M:%S") + f": Backfilled {added} samples from the CTC100 log.")
+
+def recover(outage_start, t):
+    """
+    Read the CTC100's log from `outage_start` up to the sample at `t` and
+    backfill it. Runs on its own thread; the log is read in chunks, so
+    the samples' queries get their turn on the controller in between.
+    """
+    try:
+        interval = c.log_interval
+        count = min(max_backfill, int((t - outage_start) / interval) + 1)
+        log_times, log_values = c.read_log(channels, count, chunk=log_chunk)
+        keep = log_times < t - interval / 2 # The sample at t was written live
+        log_values = {channel: series[keep] for channel, series in log_values.items()}
+        storage.call(backfill, log_times[keep], log_values, interval / 2)
+    except Exception:
+        print(datetime.now().strftime("%H:%M:%S") + ": Couldn't read the CTC100 log.")
+        print(traceback.format_exc())
+
 print("Connected to all devices.")
-ctc_error = []
 
 
-while True:
+def sample():
+    """One high_freq_time sample; the scheduler calls it on a fixed grid."""
+    global outage_start, send_permanent
     time_str = datetime.now().strftime("%H:%M:%S")
     t = time.time()
-    channel_val = [t]
+    channel_val = [t] # Owned by the storage queue once written
 
-    if send_permanent:
-        time_start = time.time()
+    # The tick counts deadlines since the start, so this cadence doesn't drift.
+    send_permanent = sampler.tick % permanent_every == 0
 
     # try:
     #     point = Point("pulse_tube")
@@ -92,48 +183,51 @@ while True:
 
 
     try:
-        ctc_error.clear()
         ## point = Point("temperatures")
 
+        # One getOutput round trip for every channel
+        values = c.read_all()
         for channel in channels:
-            value = c.read(channel)
+            value = values.get(channel)
             # # point.field(channel, value)
             channel_val.append(value)
-            ("Channel", channel,": ", value,"\n")
-            print(channel_val)
+        print(channel_val)
+
+        if all(v is None or math.isnan(v) for v in channel_val[1:]):
+            raise TimeoutError("CTC100 did not answer.")
+
+        if outage_start is not None:
+            # Recover what the controller logged while we couldn't reach it,
+            # on another thread so the samples keep their cadence meanwhile.
+            threading.Thread(target=recover, args=(outage_start, t), name="CTC100 backfill", daemon=True).start()
+            outage_start = None
         # # write_api.write(bucket=bucket_live, org="onix", record=point)
         # # if send_permanent:
         # #     write_api.write(bucket=bucket_permanent, org="onix", record=point)
 
-
+    except DeviceUnavailable:
+        # The driver reconnects in the background; don't wait on it.
+        print(time_str + ": CTC100 unavailable.")
+        outage_start = outage_start or t
     except:
         print(time_str + ": CTC100 error.")
         print(traceback.format_exc())
-        ctc_error.append(0)
-        if len(ctc_error) >= 10:
-            try:
-                c.close()
-            except:
-                pass
-            try:
-                c = CTC100("192.168.0.105")
-            except:
-                print(time_str + ": Couldn't reconnect to CTC100.")
-
-    # while datetime.datetime.now().day == today_date:
-
-
+        outage_start = outage_start or t
 
-    today_date = datetime.today().strftime('%Y-%m-%d')
-    filename = f"{today_date}.csv"
+    # Keep the row complete if the CTC100 didn't answer for every channel.
+    channel_val += [None] * (1 + len(channels) - len(channel_val))
+    for gauge in gauges:
+        channel_val += gauge.latest() # Whatever each gauge last read; None if stale
 
-    headers = columns
-
-    with open(filename, mode='a', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=headers)
-        writer.writerow({'Time': channel_val[0], '40K plat': channel_val[1], '4K cyl': channel_val[2], '40K shield': channel_val[3], 'ivc': channel_val[4]})
+    ring.write(channel_val)
+    if server is not None:
+        server.publish(channel_val)
+    storage.write(channel_val)
+    if send_permanent:
+        permanent.write(channel_val)
 
-    channel_val.clear()
+    if prometheus_file is not None:
+        write_prometheus(prometheus_file, [c])
 
     # # try:    # uploading data from temperature sensors
     # #     ruuvi_data_dict = asyncio.run(ruuvi_g.get_data(ruuvi_dont_save))
@@ -172,13 +266,11 @@ while True:
     #     print(time_str + ": Pressure gauge error.")
     #     print(traceback.format_exc())
 
-    time_end = time.time()
-    delta_time = time_end - time_start
-    send_permanent = False
-    if delta_time >= low_freq_time:
-        send_permanent = True
-
-
 
 
-    time.sleep(high_freq_time)
\ No newline at end of file
+scheduler = Scheduler()
+sampler = scheduler.every(high_freq_time, sample, name="CTC100")
+for gauge in gauges:
+    scheduler.every(gauge.period, gauge.poll, name=gauge.name)
+atexit.register(lambda: print(scheduler.report()))
+scheduler.run()
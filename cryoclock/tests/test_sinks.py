@@ -0,0 +1,170 @@
+"""
+Tests for monitoring/sinks.py. InfluxSink talks to a stand-in InfluxDB
+write endpoint on a local http.server.
+
+    $ python -m pytest cryoclock/tests
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import json, math, os, sys, tempfile, threading, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from monitoring.sinks import CSVSink, InfluxSink
+
+COLUMNS = ['Time', '40K plat', '4K cyl']
+
+
+class FakeInflux(ThreadingHTTPServer):
+    """Records every write; answers with `status`."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.status = 204
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def lines(self) -> list:
+        return [line for request in self.requests for line in request['body'].splitlines()]
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        url = urlsplit(self.path)
+        status = self.server.status
+        if status < 300:
+            self.server.requests.append({
+                'path': url.path,
+                'query': {key: values[-1] for key, values in parse_qs(url.query).items()},
+                'authorization': self.headers.get('Authorization'),
+                'body': body,
+            })
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+
+class InfluxSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeInflux()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.spill = tempfile.TemporaryDirectory()
+        self.sink = InfluxSink(self.server.url, 'live', COLUMNS, token='secret', batch_size=2, backoff=0, spill_directory=self.spill.name)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.spill.cleanup()
+
+
+    def test_writes_line_protocol(self):
+        self.sink.write([1000.0, 41.5, None])
+        self.sink.write([1001.5, math.nan, 4.25])
+        self.assertEqual(len(self.server.requests), 1)
+
+        request = self.server.requests[0]
+        self.assertEqual(request['path'], '/api/v2/write')
+        self.assertEqual(request['query'], {'org': 'onix', 'bucket': 'live', 'precision': 'ms'})
+        self.assertEqual(request['authorization'], 'Token secret')
+        self.assertEqual(self.server.lines(), [
+            r'temperatures 40K\ plat=41.5 1000000',
+            r'temperatures 4K\ cyl=4.25 1001500',
+        ])
+        self.assertEqual(self.sink.stats()['sent'], 2)
+
+
+    def test_spills_and_replays_in_order(self):
+        self.server.status = 503
+        self.sink.write([1.0, 1.0, 1.0])
+        self.sink.write([2.0, 2.0, 2.0])
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(len(self.sink.spill_files()), 1)
+
+        self.server.status = 204
+        self.sink.write([3.0, 3.0, 3.0])
+        self.sink.write([4.0, 4.0, 4.0])
+        self.assertEqual([line.split()[-1] for line in self.server.lines()], ['1000', '2000', '3000', '4000'])
+        self.assertEqual(self.sink.spill_files(), [])
+        self.assertEqual(self.sink.stats(), {'sent': 4, 'spilled': 2, 'rejected': 0, 'pending': 0})
+
+
+    def test_rejected_batches_are_dropped(self):
+        self.server.status = 400
+        self.sink.write([1.0, 1.0, 1.0])
+        self.sink.write([2.0, 2.0, 2.0])
+        self.assertEqual(self.sink.spill_files(), [])
+        self.assertEqual(self.sink.stats()['rejected'], 2)
+
+
+
+class _FailingWriter:
+    """Stands in for DailyCSVWriter; raises on the `fail_at`th write."""
+
+    def __init__(self, fail_at):
+        self.rows = []
+        self.fail_at = fail_at
+
+    def write(self, row):
+        if len(self.rows) + 1 == self.fail_at:
+            self.fail_at = None
+            raise OSError('The share went away.')
+        self.rows.append(list(row))
+
+    def flush(self): pass
+
+    def close(self): pass
+
+
+
+class WriterSinkTest(unittest.TestCase):
+
+    def test_partial_failure_spills_only_the_rest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sink = CSVSink(directory, COLUMNS, batch_size=4, backoff=0, spill_directory=os.path.join(directory, 'spill'))
+            sink.writer = _FailingWriter(fail_at=3)
+            for t in range(4):
+                sink.write([float(t), 1.0, 2.0])
+
+            spilled = sink.spill_files()
+            self.assertEqual(len(spilled), 1)
+            with open(spilled[0]) as file:
+                self.assertEqual([json.loads(line)[0] for line in file], [2.0, 3.0])
+
+            sink.flush() # Replays the spill
+            self.assertEqual([row[0] for row in sink.writer.rows], [0.0, 1.0, 2.0, 3.0])
+            self.assertEqual(sink.stats(), {'sent': 4, 'spilled': 2, 'rejected': 0, 'pending': 0})
+
+
+    def test_sinks_only_replay_their_own_spill_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spill = os.path.join(directory, 'spill')
+            live = CSVSink(directory, COLUMNS, name='csv', batch_size=1, backoff=0, spill_directory=spill)
+            permanent = CSVSink(directory, COLUMNS, name='csv-permanent', batch_size=1, backoff=0, spill_directory=spill)
+            live.writer, permanent.writer = _FailingWriter(fail_at=None), _FailingWriter(fail_at=1)
+
+            permanent.write([1.0, 1.0, 2.0])
+            self.assertEqual(live.spill_files(), [])
+            self.assertEqual(len(permanent.spill_files()), 1)
+
+            live.write([2.0, 1.0, 2.0])
+            self.assertEqual([row[0] for row in live.writer.rows], [2.0])
+            self.assertEqual(len(permanent.spill_files()), 1)
+
+            permanent.flush()
+            self.assertEqual([row[0] for row in permanent.writer.rows], [1.0])
+            self.assertEqual(permanent.spill_files(), [])
+
+
+
+if __name__ == '__main__':
+    unittest.main()